@@ -0,0 +1,70 @@
+"""
+Compares parsing of the google sheets with pandas (parse_df()) vs. the row-oriented parser (parse_rows())
+on a synthetic sheet. Runs offline: the sheet values are generated in the format returned by the Sheets API.
+
+Usage: python benchmark_google_sheets.py [rows] [repeats]
+"""
+import sys
+import timeit
+
+import pandas as pd
+
+from googleapi import OBSGoogleSheets, TimingGoogleSheets
+from googleapi.google_sheets import OBS_SHEET_COLUMNS
+
+
+def obs_rows(n):
+    rows = [OBS_SHEET_COLUMNS]
+    for i in range(n):
+        rows.append([
+            f"L{i:03d}",
+            f"rtmp://source.example.com/live/{i}",
+            "rtmp://a.rtmp.youtube.com/live2",
+            f"key-{i:04d}-xxxx-xxxx",
+            f"https://drive.google.com/drive/folders/1AbCdEfGhIjKlMnOpQrStUvWxYz{i:04d}" if i % 2 else "",
+        ])
+    return rows
+
+
+def timing_rows(n):
+    rows = [["timestamp", "name"]]
+    for i in range(n):
+        timestamp = f"{i // 60:02d}:{i % 60:02d}:{i % 60:02d}" + (".250" if i % 3 == 0 else "")
+        rows.append([timestamp, f"{i:02d}_video.mp4"])
+    return rows
+
+
+def to_df(rows):
+    # what Worksheet.get_as_df() builds from the same values
+    return pd.DataFrame(rows[1:], columns=rows[0])
+
+
+def timing_parse_df(df):
+    # TimingGoogleSheets.pull() before the row-oriented parser
+    df["timestamp"] = df["timestamp"].apply(TimingGoogleSheets.to_timedelta)
+    return df[["timestamp", "name"]]
+
+
+def bench(name, foo, repeats):
+    best = min(timeit.repeat(foo, number=1, repeat=repeats))
+    print(f"{name:<40} {best * 1000:8.3f} ms")
+    return best
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    obs_sheets, timing_sheets = OBSGoogleSheets(), TimingGoogleSheets()
+    obs, timing = obs_rows(n), timing_rows(n)
+
+    assert obs_sheets.parse_df(to_df(obs)) == obs_sheets.parse_rows(obs)
+    assert [tuple(x) for x in timing_parse_df(to_df(timing)).values] == timing_sheets.parse_rows(timing)
+
+    print(f"{n} rows, best of {repeats}")
+    df_time = bench("obs: DataFrame + parse_df()", lambda: obs_sheets.parse_df(to_df(obs)), repeats)
+    rows_time = bench("obs: parse_rows()", lambda: obs_sheets.parse_rows(obs), repeats)
+    print(f"{'obs: speedup':<40} {df_time / rows_time:8.1f} x")
+    df_time = bench("timing: DataFrame + apply()", lambda: timing_parse_df(to_df(timing)), repeats)
+    rows_time = bench("timing: parse_rows()", lambda: timing_sheets.parse_rows(timing), repeats)
+    print(f"{'timing: speedup':<40} {df_time / rows_time:8.1f} x")
@@ -0,0 +1,144 @@
+"""
+Counts obs-websocket round trips and wall time of OBSMonitoring syncs, with and without request batching
+(ExecuteBatch). Runs offline: obs is emulated in-process, every round trip costs `latency` milliseconds.
+
+Usage: python benchmark_obs_sync.py [latency_ms] [repeats]
+"""
+import sys
+import time
+from types import SimpleNamespace
+
+import obswebsocket as obsws
+
+from models import MinionSettings
+from obs import OBS, OBSController
+from obs.obs import RequestBatch
+from obs.server import OBSMonitoring
+
+
+class EmulatedOBS(obsws.obsws):
+    """Minimal in-memory obs-websocket 4.9 server, supports the requests used by OBSMonitoring"""
+
+    def __init__(self, latency):
+        super(EmulatedOBS, self).__init__()
+        self.latency = latency
+        self.scene = "main"
+        self.sources = {"Desktop Audio": self._source("pulse_output_capture", {"device_id": "default"})}
+        self.scene_items = []  # source names
+
+    @staticmethod
+    def _source(kind, settings):
+        return {"kind": kind, "settings": dict(settings or {}), "filters": [], "volume": 0.0,
+                "muted": False, "monitor_type": "none"}
+
+    @property
+    def connected(self):
+        return self.ws is not None
+
+    def connect(self):
+        self.ws = SimpleNamespace(connected=True)
+
+    def disconnect(self):
+        self.ws = None
+
+    def send(self, data):
+        time.sleep(self.latency)  # one round trip
+        if data["request-type"] == "ExecuteBatch":
+            results = [{**self._handle(request), "message-id": request["message-id"]} for request in data["requests"]]
+            return {"status": "ok", "results": results, "message-id": data.get("message-id")}
+        return {**self._handle(data), "message-id": data.get("message-id")}
+
+    def _handle(self, data):
+        request_type = data["request-type"]
+        name = data.get("sourceName") or data.get("source")
+        source = self.sources.get(name)
+        if request_type == "GetCurrentScene":
+            return {"status": "ok", "name": self.scene}
+        if request_type == "GetSceneItemList":
+            items = [{"itemId": i, "sourceName": name_, "sourceKind": self.sources[name_]["kind"]}
+                     for i, name_ in enumerate(self.scene_items)]
+            return {"status": "ok", "sceneName": self.scene, "sceneItems": items}
+        if request_type == "CreateSource":
+            self.sources[name] = self._source(data["sourceKind"], data["sourceSettings"])
+            self.scene_items.append(name)
+            return {"status": "ok", "itemId": len(self.scene_items)}
+        if request_type == "DeleteSceneItem":
+            self.scene_items.remove(data["item"])
+            return {"status": "ok"}
+        if source is None:
+            return {"status": "error", "error": "specified source doesn't exist"}
+        filters = {f["name"]: f for f in source["filters"]}
+        if request_type == "GetSourceSettings":
+            return {"status": "ok", "sourceName": name, "sourceType": source["kind"],
+                    "sourceSettings": source["settings"]}
+        if request_type == "SetSourceSettings":
+            source["settings"].update(data["sourceSettings"] or {})
+        elif request_type == "GetSourceFilters":
+            return {"status": "ok", "filters": [dict(f) for f in source["filters"]]}
+        elif request_type == "AddFilterToSource":
+            source["filters"].append({"name": data["filterName"], "type": data["filterType"],
+                                      "settings": data["filterSettings"], "enabled": True})
+        elif request_type == "RemoveFilterFromSource":
+            source["filters"].remove(filters[data["filterName"]])
+        elif request_type == "SetSourceFilterSettings":
+            filters[data["filterName"]]["settings"] = data["filterSettings"]
+        elif request_type == "SetSourceFilterVisibility":
+            filters[data["filterName"]]["enabled"] = data["filterEnabled"]
+        elif request_type == "SetVolume":
+            source["volume"] = data["volume"]
+        elif request_type == "SetMute":
+            source["muted"] = data["mute"]
+        elif request_type == "SetAudioMonitorType":
+            source["monitor_type"] = data["monitorType"]
+        else:
+            return {"status": "error", "error": f"invalid request type {request_type}"}
+        return {"status": "ok"}
+
+
+def make_monitoring(latency):
+    controller = SimpleNamespace(minion_settings=MinionSettings.default())
+    monitoring = OBSMonitoring(obs=EmulatedOBS(latency), obs_wrapper=None, obs_controller=controller,
+                               run_monitoring=False)
+    controller.obs_monitoring = monitoring
+    OBSController._spawn_teamspeak_source(controller)
+    OBSController._spawn_main_stream_source(controller)
+    return monitoring, controller
+
+
+def measure(foo, monitoring):
+    round_trips, t = monitoring.round_trips, time.monotonic()
+    foo()
+    return monitoring.round_trips - round_trips, (time.monotonic() - t) * 1000
+
+
+def run(batched, latency, repeats):
+    monitoring, controller = make_monitoring(latency)
+    RequestBatch.set_supported(monitoring.obs, batched)
+
+    def volume_change():
+        controller.minion_settings.ts_volume.value -= 1
+        monitoring.sync_inputs([OBS.TEAMSPEAK_SOURCE_NAME])
+
+    def cold_cache():
+        monitoring.invalidate()
+        monitoring.sync()
+
+    results = {"initial sync": measure(monitoring.sync, monitoring)}
+    for name, foo in (("full re-check (no cache)", cold_cache),
+                      ("steady state (cached)", monitoring.sync),
+                      ("targeted volume change", volume_change)):
+        samples = [measure(foo, monitoring) for _ in range(repeats)]
+        results[name] = (samples[0][0], min(ms for _, ms in samples))
+    return results
+
+
+if __name__ == "__main__":
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.002
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    sequential, batched = run(False, latency, repeats), run(True, latency, repeats)
+    print(f"{latency * 1000:.1f} ms per round trip, best of {repeats}")
+    print(f"{'':<28} {'sequential':>20} {'batched':>20}")
+    for name in sequential:
+        (rt_s, ms_s), (rt_b, ms_b) = sequential[name], batched[name]
+        print(f"{name:<28} {rt_s:>5} rt {ms_s:>9.2f} ms {rt_b:>5} rt {ms_b:>9.2f} ms")
@@ -1 +1 @@
-from googleapi.google_sheets import OBSGoogleSheets, TimingGoogleSheets, UsersGoogleSheets
+from googleapi.google_sheets import OBSGoogleSheets, TimingGoogleSheets, UsersGoogleSheets, GoogleSheetsClient
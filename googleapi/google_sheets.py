@@ -1,85 +1,195 @@
 # REFACTORING: delete this file, use sheets.py
 
+import hashlib
+import json
 import os
 import re
 from datetime import timedelta, datetime
-from typing import Dict
+from typing import Dict, List, Tuple
 from copy import deepcopy
+from threading import Lock, RLock
 
-import pandas as pd
 import pygsheets
 from dotenv import load_dotenv
 
 from models import MinionSettings, User
 
+try:  # pandas is only needed for the DataFrame helpers (parse_df(), to_df()), sheets are parsed without it
+    import pandas as pd
+except ImportError:
+    pd = None
+
 load_dotenv()
 MEDIA_DIR = os.getenv("MEDIA_DIR", "./content")
 API_KEY = os.getenv("GDRIVE_API_KEY", "")
 SYNC_SECONDS = int(os.getenv("GDRIVE_SYNC_SECONDS", 120))
 GDRIVE_SYNC_ADDR = "http://localhost:7000"
 SERVICE_FILE = os.getenv("SERVICE_ACCOUNT_FILE")
+USERS_FIRST_ROW = 4  # first 3 rows of users sheet are headers
+OBS_SHEET_COLUMNS = ["lang", "source_url", "target_server", "target_key", "gdrive_folder_url"]
+
+GDRIVE_FOLDER_ID_RE = re.compile(r"\/folders\/(?P<id>[a-zA-Z0-9\_\-]+)")
+TIMESTAMP_RE = re.compile(r"(?P<hour>\d{1,2}):(?P<minute>\d{2}):(?P<second>\d{2})(?:\.(?P<microsecond>\d{1,6}))?")
+
+
+class GoogleSheetsClient:
+    """
+    Process-wide pygsheets client. It is authorized lazily on first use, so that the server starts without
+    network access, and is shared by all the sheets, so the OAuth token and HTTP connections are reused.
+    httplib2 connections are not thread-safe, so every request should be done under `GoogleSheetsClient.lock`
+    """
+
+    lock = RLock()
+    _client: pygsheets.client.Client = None
+    _worksheets: Dict[tuple, pygsheets.Worksheet] = {}  # (sheet_url, worksheet_name): worksheet
+
+    @classmethod
+    def get(cls) -> pygsheets.client.Client:
+        with cls.lock:
+            if cls._client is None:
+                cls._client = pygsheets.authorize(service_account_file=SERVICE_FILE)
+            return cls._client
+
+    @classmethod
+    def worksheet(cls, sheet_url, worksheet_name) -> pygsheets.Worksheet:
+        """Returns a cached worksheet handle, opens the spreadsheet on the first call only"""
+        with cls.lock:
+            key = (sheet_url, worksheet_name)
+            if key not in cls._worksheets:
+                cls._worksheets[key] = cls.get().open_by_url(sheet_url).worksheet_by_title(worksheet_name)
+            return cls._worksheets[key]
+
+    @classmethod
+    def get_values(cls, ws: pygsheets.Worksheet, value_range: str = None) -> List[list]:
+        """
+        Returns values of the worksheet (or of `value_range` of it, e.g. "A4:D") as a list of rows
+        with a single request. Trailing empty cells and rows are not returned
+        """
+        value_range = f"'{ws.title}'" if value_range is None else f"'{ws.title}'!{value_range}"
+        with cls.lock:
+            return cls.get().get_range(ws.spreadsheet.id, value_range)
+
+
+def rows_to_records(rows: List[list], columns: List[str]) -> List[list]:
+    """
+    Takes rows of a sheet where the first one is a header, returns [... [value of columns[0], ...], ...]
+    for every non-empty row
+    """
+    if not rows:
+        return []
+    header = rows[0]
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise KeyError(f"Columns {missing} are missing in the sheet")
+    indexes = [header.index(column) for column in columns]
+    return [
+        [row[i] if i < len(row) else "" for i in indexes]
+        for row in rows[1:]
+        if any(row)
+    ]
 
 
 class OBSGoogleSheets:
     def __init__(self):
         self.service_file = SERVICE_FILE
-        self.gc = pygsheets.authorize(service_account_file=self.service_file)
 
         self.sheet = None
         self.ws = None
 
         self.setup_status = False
 
+    @property
+    def gc(self):
+        return GoogleSheetsClient.get()
+
     def set_sheet(self, sheet_url, worksheet_name):
-        self.sheet = self.gc.open_by_url(sheet_url)
-        self.ws = self.sheet.worksheet_by_title(worksheet_name)
+        self.ws = GoogleSheetsClient.worksheet(sheet_url, worksheet_name)
+        self.sheet = self.ws.spreadsheet
         self.setup_status = True
 
     def pull(self) -> Dict[str, MinionSettings]:
-        df = self.ws.get_as_df()  # load data from google sheets
-        return self.parse_df(df)
+        rows = GoogleSheetsClient.get_values(self.ws)  # load data from google sheets
+        return self.parse_rows(rows)
+
+    def pull_changed(self, row_hashes: Dict[str, str] = None) -> Tuple[Dict[str, MinionSettings], Dict[str, str]]:
+        """
+        Same as pull(), but hashes the row of every lang and parses only the rows whose hash differs
+        from `row_hashes`
+        :param row_hashes: {... lang: row hash, ...} returned by the previous call
+        :return: ({... lang: settings, ...} of the changed rows, {... lang: row hash, ...} of all the rows)
+        """
+        rows = GoogleSheetsClient.get_values(self.ws)  # load data from google sheets
+        row_hashes = row_hashes or {}
+        langs, hashes = {}, {}
+        for record in rows_to_records(rows, OBS_SHEET_COLUMNS):  # for each lang
+            lang = record[0]
+            if lang in hashes:
+                raise KeyError(f'Multiple entries for lang "{lang}"')
+            hashes[lang] = hashlib.md5(json.dumps(record).encode()).hexdigest()
+            if row_hashes.get(lang) != hashes[lang]:
+                self._parse_record(langs, *record)
+        return langs, hashes
+
+    @staticmethod
+    def fingerprint(settings: MinionSettings) -> tuple:
+        """Returns the values of `settings` which are managed by the sheet"""
+        return (
+            settings.addr_config.original_media_url,
+            settings.stream_settings.server,
+            settings.stream_settings.key,
+            settings.gdrive_settings.media_dir,
+            settings.gdrive_settings.api_key,
+            settings.gdrive_settings.sync_seconds,
+            settings.gdrive_settings.gdrive_sync_addr,
+            settings.gdrive_settings.folder_id,
+        )
 
     def push(self, sheet_config: Dict[str, MinionSettings]):
-        df = self.to_df(sheet_config)
-        self.ws.set_dataframe(df, (1, 1))
+        rows = [OBS_SHEET_COLUMNS] + self.to_rows(sheet_config)
+        with GoogleSheetsClient.lock:
+            self.ws.update_values((1, 1), rows)
 
-    def parse_df(self, df: pd.DataFrame) -> Dict[str, MinionSettings]:
+    def parse_rows(self, rows: List[list]) -> Dict[str, MinionSettings]:
+        """
+        :param rows: sheet values, where the first row is a header
+        """
         langs = {}
+        for record in rows_to_records(rows, OBS_SHEET_COLUMNS):  # for each lang
+            self._parse_record(langs, *record)
+        return langs
 
+    def parse_df(self, df: "pd.DataFrame") -> Dict[str, MinionSettings]:
+        langs = {}
         for id in df.index:  # for each lang
-            lang = df.loc[id, "lang"]
-            source_url = df.loc[id, "source_url"]
-            target_server = df.loc[id, "target_server"]
-            target_key = df.loc[id, "target_key"]
-            gdrive_folder_url = df.loc[id, "gdrive_folder_url"]
-
-            if gdrive_folder_url:  # validate gdrive_folder_url format
-                url = re.search(r"\/folders\/(?P<id>[a-zA-Z0-9\_\-]+)", gdrive_folder_url)
-                if not url or len(url.groups()) != 1:
-                    raise ValueError(f"Invalid link: {gdrive_folder_url}")
-                gdrive_folder_id = url.group("id")
-            else:
-                gdrive_folder_id = ""
+            self._parse_record(langs, *[df.loc[id, column] for column in OBS_SHEET_COLUMNS])
+        return langs
 
-            settings = MinionSettings.get_none()
+    def _parse_record(self, langs, lang, source_url, target_server, target_key, gdrive_folder_url):
+        if gdrive_folder_url:  # validate gdrive_folder_url format
+            url = GDRIVE_FOLDER_ID_RE.search(gdrive_folder_url)
+            if not url or len(url.groups()) != 1:
+                raise ValueError(f"Invalid link: {gdrive_folder_url}")
+            gdrive_folder_id = url.group("id")
+        else:
+            gdrive_folder_id = ""
 
-            settings.addr_config.original_media_url = source_url
-            settings.stream_settings.server = target_server
-            settings.stream_settings.key = target_key
-            settings.gdrive_settings.media_dir = MEDIA_DIR
-            settings.gdrive_settings.api_key = API_KEY
-            settings.gdrive_settings.sync_seconds = SYNC_SECONDS
-            settings.gdrive_settings.gdrive_sync_addr = GDRIVE_SYNC_ADDR
-            settings.gdrive_settings.folder_id = gdrive_folder_id
+        settings = MinionSettings.get_none()
 
-            if lang in langs:
-                raise KeyError(f'Multiple entries for lang "{lang}"')
+        settings.addr_config.original_media_url = source_url
+        settings.stream_settings.server = target_server
+        settings.stream_settings.key = target_key
+        settings.gdrive_settings.media_dir = MEDIA_DIR
+        settings.gdrive_settings.api_key = API_KEY
+        settings.gdrive_settings.sync_seconds = SYNC_SECONDS
+        settings.gdrive_settings.gdrive_sync_addr = GDRIVE_SYNC_ADDR
+        settings.gdrive_settings.folder_id = gdrive_folder_id
 
-            langs[lang] = settings
+        if lang in langs:
+            raise KeyError(f'Multiple entries for lang "{lang}"')
 
-        return langs
+        langs[lang] = settings
 
-    def to_df(self, sheet_config: Dict[str, MinionSettings]) -> pd.DataFrame:
+    def to_rows(self, sheet_config: Dict[str, MinionSettings]) -> List[list]:
         rows = []
         for lang, settings in sheet_config.items():  # for each lang
             source_url = settings.addr_config.original_media_url
@@ -90,98 +200,180 @@ class OBSGoogleSheets:
             else:
                 gdrive_folder_url = ""
             rows.append([lang, source_url, target_server, target_key, gdrive_folder_url])
-        return pd.DataFrame(rows, columns=["lang", "source_url", "target_server", "target_key", "gdrive_folder_url"])
+        return rows
+
+    def to_df(self, sheet_config: Dict[str, MinionSettings]) -> "pd.DataFrame":
+        return pd.DataFrame(self.to_rows(sheet_config), columns=OBS_SHEET_COLUMNS)
 
 
 class TimingGoogleSheets:
     def __init__(self):
         self.service_file = SERVICE_FILE
-        self.gc = pygsheets.authorize(service_account_file=self.service_file)
 
         self.sheet = None
         self.ws = None
 
         self.setup_status = False
 
+    @property
+    def gc(self):
+        return GoogleSheetsClient.get()
+
     @classmethod
     def to_timedelta(cls, timestamp_str):
         """
         :param timestamp_str: string representation of time. Format of 00:00:00[.000]
         :return:
         """
-        if re.fullmatch("\d{1,2}\:\d{2}\:\d{2}\.\d{1,6}", timestamp_str):  # format of 00:00:00.000000
-            r = re.search(r"(?P<hour>\d{1,2})\:(?P<minute>\d{2})\:(?P<second>\d{2})\.(?P<microsecond>\d{1,6})",
-                          timestamp_str)
-            hour, minute, second = int(r.group("hour")), int(r.group("minute")), int(r.group("second"))
-            microseconds = int(r.group("microsecond").ljust(6, "0"))
-            return timedelta(hours=hour, minutes=minute, seconds=second, microseconds=microseconds)
-        elif re.fullmatch("\d{1,2}\:\d{2}\:\d{2}", timestamp_str):  # format of 00:00:00
-            r = re.search(r"(?P<hour>\d{1,2})\:(?P<minute>\d{2})\:(?P<second>\d{2})", timestamp_str)
-            hour, minute, second = int(r.group("hour")), int(r.group("minute")), int(r.group("second"))
-            return timedelta(hours=hour, minutes=minute, seconds=second)
-        else:
-            raise f"Timestamp has invalid format: {timestamp_str}"
+        r = TIMESTAMP_RE.fullmatch(timestamp_str)  # format of 00:00:00[.000000]
+        if not r:
+            raise ValueError(f"Timestamp has invalid format: {timestamp_str}")
+        hour, minute, second = int(r.group("hour")), int(r.group("minute")), int(r.group("second"))
+        microseconds = int(r.group("microsecond").ljust(6, "0")) if r.group("microsecond") else 0
+        return timedelta(hours=hour, minutes=minute, seconds=second, microseconds=microseconds)
 
     def set_sheet(self, sheet_url, worksheet_name):
-        self.sheet = self.gc.open_by_url(sheet_url)
-        self.ws = self.sheet.worksheet_by_title(worksheet_name)
+        self.ws = GoogleSheetsClient.worksheet(sheet_url, worksheet_name)
+        self.sheet = self.ws.spreadsheet
         self.setup_status = True
 
-    def pull(self) -> pd.DataFrame:
+    def pull(self) -> List[Tuple[timedelta, str]]:
         """
-        df - dataframe, e.g.:
+        Sheet, e.g.:
         timestamp   name
         0:12:00     01_video.mp4
         05:10:12    02_video.mp4
         12:01:01    03_video.mp4
+        :return: [... (timestamp, name), ...]
         """
-        df = self.ws.get_as_df()  # load data from google sheets
+        rows = GoogleSheetsClient.get_values(self.ws)  # load data from google sheets
+        return self.parse_rows(rows)
 
-        df["timestamp"] = df["timestamp"].apply(TimingGoogleSheets.to_timedelta)
-        df = df[["timestamp", "name"]]
-
-        return df
+    def parse_rows(self, rows: List[list]) -> List[Tuple[timedelta, str]]:
+        """
+        :param rows: sheet values, where the first row is a header
+        """
+        return [
+            (TimingGoogleSheets.to_timedelta(timestamp), name)
+            for timestamp, name in rows_to_records(rows, ["timestamp", "name"])
+        ]
 
 
 class UsersGoogleSheets:
+    """
+    Note that set_passwd(), reset_passwd_hash() and set_sync_status() only buffer cell updates,
+    call flush() to write them all with a single request
+    """
+
     def __init__(self):
         self.service_file = SERVICE_FILE
-        self.gc = pygsheets.authorize(service_account_file=self.service_file)
         self.sheet = None
         self.ws = None
         self.setup_status = False
+        self._modified_time = None  # modification time of the spreadsheet as of the last fetch
+        self._content_hash = None  # hash of users data as of the last fetch
+
+        self._buffer_lock = Lock()
+        self._pending_cells: Dict[str, str] = {}  # cell: value
+        # write metrics
+        self.cells_written = 0  # number of cell updates flushed, i.e. requests it would take to write them one by one
+        self.write_requests = 0  # number of requests actually made
+
+    @property
+    def gc(self):
+        return GoogleSheetsClient.get()
 
     def set_sheet(self, sheet_url, worksheet_name):
-        self.sheet = self.gc.open_by_url(sheet_url)
-        self.ws = self.sheet.worksheet_by_title(worksheet_name)
+        self.ws = GoogleSheetsClient.worksheet(sheet_url, worksheet_name)
+        self.sheet = self.ws.spreadsheet
+        self.invalidate()
         self.setup_status = True
 
     def set_passwd(self, index: int, passwd_placeholder: str, passwd_hash: str):
-        self.ws.update_value(f"B{index}", passwd_placeholder)
-        self.ws.update_value(f"C{index}", passwd_hash)
+        self._buffer({f"B{index}": passwd_placeholder, f"C{index}": passwd_hash})
 
     def set_sync_status(self, message: str):
         now = datetime.now()
         now_formatted = now.strftime("%H:%M:%S")
-        self.ws.update_value(f"F1", now_formatted)
-        self.ws.update_value(f"F2", message)
+        self._buffer({"F1": now_formatted, "F2": message})
 
     def reset_passwd_hash(self, index: int):
-        self.ws.update_value(f"C{index}", "")
+        self._buffer({f"C{index}": ""})
+
+    def flush(self):
+        """Writes all the buffered cell updates with a single request"""
+        with self._buffer_lock:
+            cells, self._pending_cells = self._pending_cells, {}
+        if not cells:
+            return
+        ranges = list(cells.keys())
+        try:
+            with GoogleSheetsClient.lock:
+                self.ws.update_values_batch(ranges, [[[cells[cell]]] for cell in ranges])
+        except Exception:
+            with self._buffer_lock:  # put the cells back for the next flush, unless they have been updated meanwhile
+                self._pending_cells = {**cells, **self._pending_cells}
+            raise
+        with self._buffer_lock:
+            self.cells_written += len(cells)
+            self.write_requests += 1
+
+    def write_stats(self) -> dict:
+        with self._buffer_lock:
+            return {
+                "cells_written": self.cells_written,
+                "write_requests": self.write_requests,
+                "requests_saved": self.cells_written - self.write_requests,
+                "pending_cells": len(self._pending_cells),
+            }
+
+    def _buffer(self, cells: Dict[str, str]):
+        with self._buffer_lock:
+            self._pending_cells.update(cells)  # the latest value of a cell wins
 
     def fetch_all(self) -> list:
-        skip = 3  # skip rows from beginning
-        logins_col = self.ws.get_col(1, include_tailing_empty=False)[skip:]
-        passwd_col = self.ws.get_col(2, include_tailing_empty=False)[skip:]
-        hashes_col = self.ws.get_col(3, include_tailing_empty=False)[skip:]
-        perms_col = self.ws.get_col(4, include_tailing_empty=False)[skip:]
-        logins_len = len(logins_col)
-        passwd_len = len(passwd_col)
-        hashes_len = len(hashes_col)
-        return [{
-            "col": i + skip + 1,
-            "login": logins_col[i] if i < logins_len else "",
-            "passwd": passwd_col[i] if i < passwd_len else "",
-            "hash": hashes_col[i] if i < hashes_len else "",
-            "permissions": [] if perms_col[i].strip() == "" else perms_col[i].split(" ")
-        } for i in range(len(logins_col))]
+        return self._parse_rows(self._fetch_rows())
+
+    def fetch_if_changed(self):
+        """
+        Same as fetch_all(), but returns None if users data has not been changed since the last fetch.
+        Checks the spreadsheet modification time first (a lightweight Drive API request), and reads the data
+        only if the spreadsheet has been modified. Note that writes to the sheet modify it as well, so the data
+        is compared by hash after reading
+        """
+        try:
+            with GoogleSheetsClient.lock:
+                modified_time = self.sheet.updated
+        except Exception:  # e.g. Drive API is not available - fall back to reading the data
+            modified_time = None
+        if modified_time is not None and modified_time == self._modified_time:
+            return None
+
+        rows = self._fetch_rows()
+        content_hash = hashlib.md5(json.dumps(rows).encode("utf-8")).hexdigest()
+        self._modified_time = modified_time
+        if content_hash == self._content_hash:
+            return None
+        self._content_hash = content_hash
+        return self._parse_rows(rows)
+
+    def invalidate(self):
+        """Makes the next fetch_if_changed() read and return the data regardless of changes"""
+        self._modified_time, self._content_hash = None, None
+
+    def _fetch_rows(self) -> list:
+        # single request for all the columns, rows are returned without trailing empty cells
+        return GoogleSheetsClient.get_values(self.ws, f"A{USERS_FIRST_ROW}:D")
+
+    def _parse_rows(self, rows: list) -> list:
+        result = []
+        for i, row in enumerate(rows):
+            login, passwd, passwd_hash, perms = (list(row) + [""] * 4)[:4]
+            result.append({
+                "col": i + USERS_FIRST_ROW,
+                "login": login,
+                "passwd": passwd,
+                "hash": passwd_hash,
+                "permissions": [] if perms.strip() == "" else perms.split(" ")
+            })
+        return result
@@ -1,6 +1,6 @@
 import os
 from datetime import datetime, timedelta
-from threading import RLock
+from threading import Condition
 from typing import List, Dict
 
 from pydantic import BaseModel, PrivateAttr
@@ -61,6 +61,12 @@ class User:
     def is_admin(self) -> bool:
         return "admin" in self.permissions if self and self.permissions else False
 
+    def permissions_key(self) -> str:
+        """Returns a key which is equal for users who have access to the same data"""
+        if self.is_admin():
+            return "admin"
+        return "+".join(sorted(set(self.permissions)))
+
     def langs(self):
         if self.permissions:
             if "admin" in self.permissions or "*" in self.permissions:
@@ -74,18 +80,30 @@ class SessionContext:
         self.sid: str = kwargs["sid"] if "sid" in kwargs else None
         self.ip: str = kwargs["ip"] if "ip" in kwargs else None
         self.user: User = kwargs["user"] if "user" in kwargs else None
+        # if set, per-lang results of the command are streamed to the client as soon as they arrive
+        self.progress_id: str = kwargs["progress_id"] if "progress_id" in kwargs else None
 
 
 class OBSCloudModel(BaseModel):
     _objvers: str = PrivateAttr("")
+    _change_listener = PrivateAttr(None)  # called with no arguments whenever a public field changes
 
     def __init__(self, **kwargs):
         super(OBSCloudModel, self).__init__(**kwargs)
 
     def __setattr__(self, key, value):
-        if hasattr(self, key) and self.__getattribute__(key) != value:
+        if key in self.__private_attributes__:
+            super().__setattr__(key, value)
+            return
+        changed = hasattr(self, key) and self.__getattribute__(key) != value
+        if changed:
             super().__setattr__("_objvers", "M")
         super().__setattr__(key, value)
+        if changed and self._change_listener is not None:
+            self._change_listener()
+
+    def set_change_listener(self, listener):
+        self._change_listener = listener
 
     def objvers(self) -> str:
         return self._objvers
@@ -179,6 +197,7 @@ class MinionSettings(BaseModel):
     ts_gain_settings: GainSettings = GainSettings()
     transition_settings: TransitionSettings = TransitionSettings()
     gdrive_settings: GDriveSettings = GDriveSettings()
+    _change_listener = PrivateAttr(None)  # see set_change_listener()
 
     @classmethod
     def get_none(cls):
@@ -203,6 +222,33 @@ class MinionSettings(BaseModel):
                 if value is not None:  # None - means the option is disabled
                     my_subject.__setattr__(key, value)  # copy from other subject
 
+    def patch(self) -> Optional[dict]:
+        """
+        Returns {... subject: {... field: value, ...}, ...} of the modified subjects only, or None if some
+        subject has never been activated, then the whole config should be sent
+        """
+        patch = {}
+        for subject_name in self.__fields__:
+            subject = self.get_subject(subject_name)
+            if not subject.objvers():
+                return None
+            if subject.is_modified():
+                patch[subject_name] = subject.dict()
+        return patch
+
+    def apply_patch(self, patch: dict):
+        """
+        Works the same as modify_from(), but takes the output of patch(): only the subjects listed are changed
+        """
+        for subject in patch:
+            if subject not in self.__fields__:
+                raise KeyError(f"Invalid subject '{subject}'")
+        for subject, subject_dict in patch.items():
+            my_subject = self.get_subject(subject)
+            for key, value in subject_dict.items():
+                if value is not None:  # None - means the option is disabled
+                    my_subject.__setattr__(key, value)
+
     def list_subjects(self):
         return [x for x in self.dict().keys()]
 
@@ -219,6 +265,21 @@ class MinionSettings(BaseModel):
         for subject in self.list_subjects():
             self.__getattribute__(subject).activate()
 
+    def set_change_listener(self, listener):
+        """
+        Binds `listener` to every subject, so that any field change inside the settings is reported.
+        A subject assigned later is bound as well, see __setattr__()
+        """
+        self._change_listener = listener
+        for subject in self.list_subjects():
+            self.get_subject(subject).set_change_listener(listener)
+
+    def __setattr__(self, key, value):
+        super(MinionSettings, self).__setattr__(key, value)
+        if key not in self.__private_attributes__ and self._change_listener is not None:
+            self.get_subject(key).set_change_listener(self._change_listener)
+            self._change_listener()
+
 
 class VmixPlayer(BaseModel):
     name: str
@@ -230,6 +291,11 @@ class TimingEntry(BaseModel):
     timestamp: timedelta  # format of hh:mm:ss
     is_enabled: bool = True
     is_played: bool = False
+    scheduled_time: datetime = None  # system time the entry is scheduled to be played at
+    fired_time: datetime = None  # system time the entry has actually been played at (by the timing clock)
+    # fired_time - scheduled_time, in milliseconds, on the Skipper. Minions which have the entry armed fire it
+    # by their own clocks, see 'cue_fires' of their 'get sync stats'
+    jitter_ms: float = None
 
     class Config:
         json_loads = orjson.loads
@@ -267,30 +333,74 @@ class Registry(BaseModel):
     # {"lang1": {"filename1": True/False (downloaded), "filename2": ...}, "lang2": ...}
     gdrive_files: Dict[str, Dict] = {}
 
-    _lock = PrivateAttr()
+    # change journal: top-level keys modified since the last `drain_changes()`
+    _changes = PrivateAttr()
+    _changes_cond = PrivateAttr()
+    # copy-on-write cache of masked top-level values for readers, see `snapshot()`
+    _snapshot = PrivateAttr()
+    _snapshot_gen = PrivateAttr()  # increments on every change, protects the cache from stale values
 
     class Config:
         json_loads = orjson.loads
         json_dumps = orjson_dumps
 
     def __init__(self, **kwargs):
-        self._lock = RLock()
+        self._changes = set()
+        self._changes_cond = Condition()
+        self._snapshot = {}
+        self._snapshot_gen = 0
         super(Registry, self).__init__(**kwargs)
-
-    def __getattr__(self, item):
-        if item == "_lock":
-            return super(Registry, self).__getattr__(item)
-        with self._lock:
-            return super(Registry, self).__getattr__(item)
+        for lang in self.minion_configs:
+            self._bind_minion(lang)
 
     def __setattr__(self, key, value):
-        if key in ("_lock",):
+        if key in self.__private_attributes__:
             super(Registry, self).__setattr__(key, value)
         else:
-            with self._lock:
-                if key == "server_status":
-                    self._last_server_status = self.server_status
-                super(Registry, self).__setattr__(key, value)
+            if key == "server_status":
+                self._last_server_status = self.server_status
+            super(Registry, self).__setattr__(key, value)
+            if key == "minion_configs":
+                for lang in self.minion_configs:
+                    self._bind_minion(lang)
+            self.mark_changed(key)
+
+    def mark_changed(self, *keys):
+        """
+        Records top-level registry keys as modified and wakes up whoever waits in `drain_changes()`.
+        Call it after mutating nested structures in place (e.g. `registry.vmix_players[ip] = ...`),
+        since such mutations bypass `__setattr__`.
+        """
+        with self._changes_cond:
+            self._changes.update(keys)
+            self._snapshot_gen += 1
+            for key in keys:
+                self._snapshot.pop(key, None)
+            self._changes_cond.notify_all()
+
+    def wait_for_changes(self, timeout=None) -> bool:
+        """
+        Blocks until at least one key has been marked as changed or `timeout` seconds passed.
+        Returns True if there are pending changes
+        """
+        with self._changes_cond:
+            if not self._changes:
+                self._changes_cond.wait(timeout)
+            return bool(self._changes)
+
+    def drain_changes(self, timeout=None) -> set:
+        """
+        Blocks until at least one key has been marked as changed (or `timeout` seconds passed),
+        returns the set of changed top-level keys and clears the journal
+        """
+        with self._changes_cond:
+            if not self._changes and timeout != 0:
+                self._changes_cond.wait(timeout)
+            changes, self._changes = self._changes, set()
+            return changes
+
+    def _bind_minion(self, lang):
+        self.minion_configs[lang].set_change_listener(lambda: self.mark_changed("minion_configs"))
 
     def list_langs(self):
         return list(self.minion_configs.keys())
@@ -298,33 +408,52 @@ class Registry(BaseModel):
     def update_minion(self, lang, minion_config: MinionSettings):
         if lang not in self.minion_configs:
             self.minion_configs[lang] = MinionSettings.default()
+            self._bind_minion(lang)
+            self.mark_changed("minion_configs")
         self.minion_configs[lang].modify_from(minion_config)
 
     def delete_minion(self, lang):
         if lang in self.minion_configs:
             self.minion_configs.pop(lang)
+            self.mark_changed("minion_configs")
 
     def revert_server_state(self):
-        with self._lock:
-            super().__setattr__("server_status", self._last_server_status)
+        super().__setattr__("server_status", self._last_server_status)
+        self.mark_changed("server_status")
 
     def masked_copy(self):
-        r = self.copy()
-        r.vmix_players = {(f"hidden ip {i}" if ip != "*" else ip): vmix_player
-                          for i, (ip, vmix_player) in enumerate(r.vmix_players.items())}
+        # `copy(update=...)` doesn't go through __setattr__, so the copy doesn't feed the change journal
+        vmix_players = {(f"hidden ip {i}" if ip != "*" else ip): vmix_player
+                        for i, (ip, vmix_player) in enumerate(self.vmix_players.items())}
 
-        active_vmix_players = [[ip, vmix_player] for ip, vmix_player in r.vmix_players.items() if vmix_player.active]
-        if not active_vmix_players:
-            r.active_vmix_player = "*"
-        else:
-            r.active_vmix_player = active_vmix_players[0][0]
-        return r
+        active_vmix_players = [ip for ip, vmix_player in vmix_players.items() if vmix_player.active]
+        active_vmix_player = active_vmix_players[0] if active_vmix_players else "*"
+        return self.copy(update={"vmix_players": vmix_players, "active_vmix_player": active_vmix_player})
 
     def masked_json(self):
         return self.masked_copy().json()
 
-    def masked_dict(self):
-        return self.masked_copy().dict()
+    def masked_dict(self, include=None):
+        return self.masked_copy().dict(include=include)
+
+    def snapshot(self, include=None) -> dict:
+        """
+        Returns the masked registry dict for readers. Top-level values are cached until they are marked
+        as changed, so readers don't serialize the registry over and over again. The dict returned is shared:
+        neither it nor its nested values must be modified
+        """
+        keys = set(self.__fields__) if include is None else set(include)
+        with self._changes_cond:
+            values = {key: self._snapshot[key] for key in keys if key in self._snapshot}
+            gen = self._snapshot_gen
+        missing = keys - values.keys()
+        if missing:
+            new_values = self.masked_dict(include=missing)
+            with self._changes_cond:
+                if gen == self._snapshot_gen:  # nothing has been changed while serializing
+                    self._snapshot.update(new_values)
+            values.update(new_values)
+        return {key: values[key] for key in self.__fields__ if key in values}
 
     def get_ip_name(self, ip):
         if ip == "*":
@@ -1,2 +1,4 @@
 from obs.obs import OBS
+from obs.client import OBSClient
+from obs.media import MediaIndex
 from obs.server import OBSController
@@ -0,0 +1,205 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import queue
+import threading
+
+import aiohttp
+from obswebsocket import events
+from obswebsocket.base_classes import Baseevents, Baserequests
+
+
+class OBSClient:
+    """
+    asyncio obs-websocket client. Requests are pipelined: they are sent right away, without waiting for
+    the responses to the previous ones, and responses are matched to requests by message-id. So a media
+    switch is not queued behind a batch of the monitoring, even though they share the connection.
+
+    The client runs its own event loop in a background thread. Coroutines await `call_async()`/`gather()`,
+    threads use `call()`, which makes the client a drop-in replacement of obswebsocket.obsws: it takes
+    the same request objects (obswebsocket.requests) and triggers the same event objects (obswebsocket.events).
+    Awaitable high-level operations (OBS.*_async()) run on the client's loop, see run()
+    """
+
+    def __init__(self, host="localhost", port=4444, password="", timeout=10):
+        """
+        :param timeout: seconds to wait for the connection and for every response
+        """
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name="obs-client", daemon=True)
+        self._loop_thread.start()
+        self._session: aiohttp.ClientSession = None
+        self._ws: aiohttp.ClientWebSocketResponse = None
+        self._recv_task: asyncio.Task = None
+        self._pending = {}  # message-id: asyncio.Future, accessed from the loop only
+        self._message_id = 0
+        self._connect_lock = threading.Lock()
+
+        # event callbacks are called from a separate thread, so that they are free to call the client
+        self._handlers = []  # [... (callback, event class or None), ...]
+        self._events = queue.SimpleQueue()
+        self._events_thread = threading.Thread(target=self._dispatch_events, name="obs-client-events", daemon=True)
+        self._events_thread.start()
+
+    @property
+    def connected(self):
+        return self._ws is not None and not self._ws.closed
+
+    def connect(self):
+        with self._connect_lock:
+            if not self.connected:
+                self._run(self._connect(), timeout=self.timeout)
+
+    def disconnect(self):
+        with self._connect_lock:
+            self._run(self._disconnect(), timeout=self.timeout)
+
+    def reconnect(self):
+        self.disconnect()
+        self.connect()
+
+    def call(self, request: Baserequests) -> Baserequests:
+        """
+        Blocking call, connects if the client is not connected. Returns `request` populated with the response
+        """
+        if not self.connected:
+            self.connect()
+        return self._run(self.call_async(request))
+
+    async def call_async(self, request: Baserequests) -> Baserequests:
+        response = await asyncio.wait_for(self._send(request.data()), self.timeout)
+        request.input(response)
+        return request
+
+    async def gather(self, *requests: Baserequests):
+        """Sends all the requests at once and waits for all the responses"""
+        return await asyncio.gather(*[self.call_async(request) for request in requests])
+
+    def run(self, coro, timeout=None):
+        """
+        Blocking call, runs the coroutine on the client's event loop, e.g.
+        client.run(obs_wrapper.set_mute_async("ts_input", True)). Connects if the client is not connected
+        """
+        if not self.connected:
+            self.connect()
+        return self._run(coro, timeout)
+
+    async def run_in_thread(self, foo, *args, **kwargs):
+        """
+        Awaits a blocking operation (e.g. OBS.run_media()) run in a worker thread. Its calls are pipelined
+        with the calls of the coroutines running meanwhile
+        """
+        return await self._loop.run_in_executor(None, functools.partial(foo, *args, **kwargs))
+
+    def register(self, func, event=None):
+        """
+        :param event: event class from obswebsocket.events, None - all the events
+        """
+        self._handlers.append((func, event))
+
+    def unregister(self, func, event=None):
+        self._handlers = [(f, e) for f, e in self._handlers if f != func or (event is not None and e != event)]
+
+    def _run(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    async def _connect(self):
+        await self._disconnect()
+        self._session = aiohttp.ClientSession()
+        try:
+            self._ws = await self._session.ws_connect(f"ws://{self.host}:{self.port}", max_msg_size=0)
+            self._recv_task = self._loop.create_task(self._recv())
+            await self._auth()
+        except Exception:
+            await self._disconnect()
+            raise
+
+    async def _disconnect(self):
+        if self._recv_task is not None:
+            self._recv_task.cancel()
+            self._recv_task = None
+        if self._ws is not None:
+            await self._ws.close()
+            self._ws = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._fail_pending(ConnectionError("Disconnected from OBS"))
+
+    async def _auth(self):
+        result = await self._send({"request-type": "GetAuthRequired"})
+        if result["status"] != "ok":
+            raise ConnectionError(result.get("error"))
+        if result.get("authRequired"):
+            secret = base64.b64encode(hashlib.sha256((self.password + result["salt"]).encode("utf-8")).digest())
+            auth = base64.b64encode(
+                hashlib.sha256(secret + result["challenge"].encode("utf-8")).digest()
+            ).decode("utf-8")
+            result = await self._send({"request-type": "Authenticate", "auth": auth})
+            if result["status"] != "ok":
+                raise ConnectionError(result.get("error"))
+
+    async def _send(self, payload: dict) -> dict:
+        if not self.connected:
+            raise ConnectionError("Not connected to OBS")
+        self._message_id += 1
+        message_id = str(self._message_id)
+        future = self._pending[message_id] = self._loop.create_future()
+        try:
+            await self._ws.send_str(json.dumps({**payload, "message-id": message_id}))
+            return await future
+        finally:
+            self._pending.pop(message_id, None)
+
+    async def _recv(self):
+        try:
+            async for message in self._ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                try:
+                    data = json.loads(message.data)
+                except ValueError as ex:  # skipped, as obswebsocket.obsws does
+                    print(f"W PYSERVER::OBSClient::_recv(): invalid message: {message.data} ({ex})")
+                    continue
+                if "update-type" in data:
+                    self._events.put(data)
+                elif data.get("message-id") in self._pending:
+                    future = self._pending[data["message-id"]]
+                    if not future.done():
+                        future.set_result(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # the connection is lost, pending calls fail with ConnectionError below
+            pass
+        self._fail_pending(ConnectionError("Connection to OBS has been closed"))
+
+    def _fail_pending(self, ex):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ex)
+
+    def _dispatch_events(self):
+        while True:
+            data = self._events.get()
+            try:
+                event_class = getattr(events, data["update-type"], None)
+                event = event_class() if event_class is not None else Baseevents()
+                event.input(data)
+                if event_class is None:
+                    event.name = data["update-type"]
+            except Exception as ex:  # skipped, as obswebsocket.obsws does
+                print(f"W PYSERVER::OBSClient::_dispatch_events(): invalid event: {data} ({ex})")
+                continue
+            for func, event_filter in list(self._handlers):
+                if event_filter is None or isinstance(event, event_filter):
+                    try:
+                        func(event)
+                    except Exception:  # handlers report their own errors, e.g. OBS.on_event()
+                        pass
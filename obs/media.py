@@ -0,0 +1,174 @@
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+from util import generate_file_md5
+
+# number of a media file, e.g. "01" for "01_video.mp4". Media are searched by the number the name starts with
+MEDIA_NUM_RE = re.compile(r"(?P<file_num>[\d\.]+)_.")
+FFPROBE = shutil.which("ffprobe")  # optional, durations are not indexed without ffprobe
+# directory mtime granularity margin: a directory changed less than this many seconds ago is rescanned once more
+MTIME_SETTLE_SECONDS = 1.0
+
+
+def media_num(name) -> Optional[str]:
+    """Extracts the file number from a media name, returns None if there is no number in the name"""
+    file_num = MEDIA_NUM_RE.search(name)
+    return file_num.group("file_num") if file_num else None
+
+
+def probe_duration(path) -> Optional[float]:
+    """Returns media duration in seconds, None if ffprobe is not installed or couldn't read the file"""
+    if FFPROBE is None:
+        return None
+    try:
+        output = subprocess.run(
+            [FFPROBE, "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", path],
+            capture_output=True, text=True, timeout=30,
+        ).stdout
+        return float(output.strip())
+    except (subprocess.SubprocessError, ValueError):
+        return None
+
+
+class MediaFile(BaseModel):
+    name: str
+    path: str
+    size: int
+    mtime: float
+    md5: str = None  # None - has not been probed yet
+    duration: float = None  # seconds
+
+
+class MediaIndex:
+    """
+    Index of the media directory: file number -> MediaFile. A lookup costs a single stat() of the directory:
+    the directory is rescanned only if its mtime has changed (a file has been added, removed or renamed).
+    The directory is polled rather than watched with inotify: a stat() per lookup needs neither a new dependency
+    nor a watcher thread, and sees changes made on network mounts, which inotify doesn't report.
+    Md5 and duration are computed by refresh(), for new and modified files only, off the playback path.
+    If several files start with the same number, the first one by name is used
+    """
+
+    def __init__(self, media_dir):
+        self.media_dir = media_dir
+        self._files: Dict[str, MediaFile] = {}  # file name: MediaFile
+        self._by_num: Dict[str, MediaFile] = {}
+        self._duplicates: Dict[str, list] = {}  # file number: [... names of the files ignored, ...]
+        self._dir_mtime = None
+        self._settle_timer = None  # rescans the directory once its mtime has settled, see _rescan()
+        self._lock = threading.RLock()
+        self._probe_lock = threading.Lock()
+
+    def set_media_dir(self, media_dir):
+        with self._lock:
+            if media_dir != self.media_dir:
+                self.media_dir = media_dir
+                self._files, self._by_num, self._duplicates = {}, {}, {}
+                self._dir_mtime = None
+
+    def find(self, file_num) -> Optional[MediaFile]:
+        self._rescan_if_changed()
+        with self._lock:
+            return self._by_num.get(file_num)
+
+    def duration(self, path) -> Optional[float]:
+        """Returns duration of the media file at `path` in seconds, None if it is unknown"""
+        with self._lock:
+            file = self._files.get(os.path.basename(path))
+            return file.duration if file is not None and file.path == path else None
+
+    def list(self) -> Dict[str, dict]:
+        """
+        :return: {... file_num: {"name": ..., "path": ..., "size": ..., "mtime": ..., "md5": ...,
+                  "duration": ..., "duplicates": [...]}, ...}
+        """
+        self._rescan_if_changed()
+        with self._lock:
+            return {
+                num: {**file.dict(), "duplicates": self._duplicates.get(num, [])}
+                for num, file in self._by_num.items()
+            }
+
+    def refresh(self, known_md5: Dict[str, str] = None, names=None):
+        """
+        Rescans the directory and probes the files which have not been probed yet. Probing reads whole files,
+        so it should be called from a background thread.
+        :param known_md5: {... file name: md5, ...} of the files verified by the caller, they are not hashed again
+        :param names: probe only these files, e.g. the ones just downloaded
+        """
+        self._rescan()
+        with self._probe_lock:
+            with self._lock:
+                pending = [file for file in self._files.values()
+                           if file.md5 is None and (names is None or file.name in names)]
+            for file in pending:
+                try:
+                    md5 = (known_md5 or {}).get(file.name) or generate_file_md5(file.path)
+                    duration = probe_duration(file.path)
+                    stat = os.stat(file.path)
+                except OSError:  # has been removed meanwhile
+                    continue
+                with self._lock:
+                    # skip the file if it has been modified while being probed
+                    if self._files.get(file.name) is file and (stat.st_size, stat.st_mtime) == (file.size, file.mtime):
+                        file.md5, file.duration = md5, duration
+
+    def _rescan_if_changed(self):
+        try:
+            dir_mtime = os.stat(self.media_dir).st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        if dir_mtime is None or dir_mtime != self._dir_mtime:
+            self._rescan()
+
+    def _rescan(self):
+        with self._lock:
+            try:
+                dir_mtime = os.stat(self.media_dir).st_mtime_ns
+                entries = [entry for entry in os.scandir(self.media_dir) if entry.is_file()]
+            except OSError:
+                self._files, self._by_num, self._duplicates = {}, {}, {}
+                self._dir_mtime = None
+                return
+
+            files = {}
+            for entry in entries:
+                stat = entry.stat()
+                file = self._files.get(entry.name)
+                if file is None or (file.size, file.mtime) != (stat.st_size, stat.st_mtime):
+                    file = MediaFile(name=entry.name, path=entry.path, size=stat.st_size, mtime=stat.st_mtime)
+                files[entry.name] = file
+
+            by_num, duplicates = {}, {}
+            for name in sorted(files):  # sorted, so that the same file is picked every time
+                num = MEDIA_NUM_RE.match(name)
+                if not num:
+                    continue
+                num = num.group("file_num")
+                if num in by_num:
+                    duplicates.setdefault(num, []).append(name)
+                else:
+                    by_num[num] = files[name]
+
+            self._files, self._by_num, self._duplicates = files, by_num, duplicates
+            self._dir_mtime = dir_mtime
+            # mtime granularity of the filesystem may hide a change made in the same tick as the scan,
+            # so a directory changed recently is rescanned once more in the background, not on lookups
+            settle_in = dir_mtime / 1e9 + MTIME_SETTLE_SECONDS - time.time()
+            if settle_in > 0 and self._settle_timer is None:
+                self._settle_timer = threading.Timer(settle_in, self._settle)
+                self._settle_timer.daemon = True
+                self._settle_timer.start()
+
+    def _settle(self):
+        with self._lock:
+            self._settle_timer = None
+            self._rescan()
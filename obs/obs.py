@@ -1,5 +1,10 @@
+import threading
+import time
+import weakref
+
 import obswebsocket as obs
 import obswebsocket.requests
+from obswebsocket.base_classes import Baserequests
 from util import CallbackThread
 
 # ORIGINAL_STREAM_SOURCE_NAME = "original_stream"
@@ -44,6 +49,12 @@ class OBS:
 
         self._current_media_played = None
 
+        # Media pre-roll, see preroll_media(). The media pre-rolled is shown in place of the media playing,
+        # so media sources alternate between two names: `source_name` and `source_name`_preroll
+        self._media_sources = {}  # source_name: name of the obs source playing the media
+        self._prerolled = {}  # source_name: (path, name of the obs source pre-rolled, scene name)
+        self._preroll_lock = threading.RLock()
+
     def setup_scene(self, scene_name=None, switch_scene=True):
         """
         Creates (if not been created) a scene called `scene_name` and sets it as a current scene.
@@ -112,10 +123,13 @@ class OBS:
         """
         self.delete_source_if_exist(source_name=stream_name)
 
-    def run_media(self, path, mode=None, source_name=None, on_start=None, on_error=None, on_finish=None):
+    def run_media(self, path, mode=None, source_name=None, on_start=None, on_error=None, on_finish=None,
+                  duration=None):
         """
         Mutes original media, adds and runs the media located at `path`, and appends a listener which removes
         the media when it has finished. Fires Exception when couldn't add or mute a source.
+        If the media has been pre-rolled (see preroll_media()), the source pre-rolled is shown instead of
+        creating a new one. Otherwise, the media is pre-rolled during the transition delay, if there is one.
         :param path: media file path
         :param mode: media play mode. Possible values:
            - 'force' - stop any media being played right now, and play
@@ -126,6 +140,8 @@ class OBS:
         :param on_start: callback which is being played when the video begins. on_start()
         :param on_error: callback which is being played when an error is being thrown. on_error(ex)
         :param on_finish: callback which is being played when the video is finished. on_finish()
+        :param duration: media duration in seconds, if known (e.g. probed by the media index).
+                         Otherwise, it is requested from obs once the media has started
         :return: None if ok, otherwise throws Exception
         """
         if not source_name:
@@ -138,22 +154,32 @@ class OBS:
         if mode == OBS.PLAYBACK_MODE_CHECK_SAME and self._current_media_played == path:
             return
 
+        # the media is shown exactly `transition_point` after the command, the pre-roll is done meanwhile
+        deadline = time.monotonic() + self.transition_point / 1000
+
         def media_play_foo(filename):
             """
             Removes transition, runs media
             """
             # delay for self.transition_point / 1000
             try:
-                self.delete_source_if_exist(source_name)  # remove media, if any has been played before
-                self._run_media(filename, source_name)
+                if not self._show_preroll(filename, source_name):  # if the media has not been pre-rolled
+                    media_name = self.media_source_name(source_name)
+                    self.delete_source_if_exist(media_name)  # remove media, if any has been played before
+                    self._run_media(filename, media_name)
+                media_name = self.media_source_name(source_name)
                 self.delete_source_if_exist(source_name=OBS.TRANSITION_INPUT_NAME)
-                duration = self.client.call(obs.requests.GetMediaDuration(sourceName=source_name)).getMediaDuration()
-                self.media_cb_thread.append_callback(media_end_foo, (duration / 1000) + 1, cb_type=source_name)
+                media_duration = duration
+                if not media_duration:
+                    media_duration = self.client.call(
+                        obs.requests.GetMediaDuration(sourceName=media_name)
+                    ).getMediaDuration() / 1000
+                self.media_cb_thread.append_callback(media_end_foo, media_duration + 1, cb_type=source_name)
 
                 if on_start is not None and callable(on_start):
-                    on_start(filename, (duration / 1000) + 1)
+                    on_start(filename, media_duration + 1)
             except Exception as ex:
-                self.delete_source_if_exist(source_name)
+                self.delete_source_if_exist(self.media_source_name(source_name))
                 self._current_media_played = None
                 self.media_cb_thread.delete_cb_type(cb_type=source_name)
 
@@ -164,7 +190,7 @@ class OBS:
             """
             Deletes media, runs stinger if needed
             """
-            self.delete_source_if_exist(source_name=source_name)
+            self.delete_source_if_exist(source_name=self.media_source_name(source_name))
             if self.transition_name == "Stinger":
                 self._run_media(self.transition_path, OBS.TRANSITION_INPUT_NAME)
                 self.media_cb_thread.append_callback(
@@ -196,8 +222,111 @@ class OBS:
             raise RuntimeError("Stingers are not supported after refactoring")
 
         self._current_media_played = path
-        self.media_cb_thread.append_callback(media_play_foo, self.transition_point / 1000,
-                                             args=(path, ), cb_type=source_name)
+        # media_play_foo() waits for the pre-roll in progress, if any (see _show_preroll())
+        self.media_cb_thread.append_callback_at(media_play_foo, deadline, args=(path, ), cb_type=source_name)
+
+        if self.transition_point > 0:
+            try:  # warm the source up during the transition delay
+                self.preroll_media(path, source_name=source_name)
+            except Exception as ex:
+                print(f"W PYSERVER::OBS::run_media(): couldn't pre-roll media, details: {ex}")
+        elif self._prerolled.get(source_name, (path,))[0] != path:  # another media is played instead
+            try:
+                self.drop_preroll(source_name)
+            except Exception as ex:
+                print(f"W PYSERVER::OBS::run_media(): couldn't drop pre-rolled media, details: {ex}")
+
+    def media_source_name(self, source_name=None):
+        """
+        Returns name of the obs source playing the media of `source_name` (see preroll_media())
+        """
+        if not source_name:
+            source_name = OBS.MAIN_MEDIA_NAME
+        return self._media_sources.get(source_name, source_name)
+
+    def preroll_media(self, path, source_name=None):
+        """
+        Creates the media source for `path` ahead of time: hidden, muted and paused on the first frame,
+        so that the file is opened and decoded by the time run_media() shows it.
+        Replaces the media pre-rolled before, if it has not been played.
+        :param source_name: name of the source in OBS the media will be played as. Leave None to use default value
+        :return: None if ok, otherwise throws Exception
+        """
+        if not source_name:
+            source_name = OBS.MAIN_MEDIA_NAME
+
+        with self._preroll_lock:
+            prerolled = self._prerolled.get(source_name)
+            if prerolled is not None:
+                if prerolled[0] == path:  # pre-rolls of another scene are dropped on SwitchScenes, see on_event()
+                    return
+                self.drop_preroll(source_name)
+            scene_name = self.obsws_get_current_scene_name()
+
+            preroll_name = source_name if self.media_source_name(source_name) != source_name \
+                else f"{source_name}_preroll"
+            self.delete_source_if_exist(preroll_name, scene_name)
+
+            response = self.client.call(
+                obs.requests.CreateSource(
+                    sourceName=preroll_name,
+                    sourceKind="ffmpeg_source",
+                    sceneName=scene_name,
+                    # keep the file open while the source is hidden, and don't reopen it when it is shown
+                    sourceSettings={"local_file": path, "close_when_inactive": False, "restart_on_activate": False},
+                    setVisible=False,
+                )
+            )
+            if not response.status:
+                raise RuntimeError(f"OBS::preroll_media(): datain: {response.datain}, dataout: {response.dataout}")
+
+            batch = RequestBatch()
+            batch.add(obs.requests.SetMute(source=preroll_name, mute=True))
+            batch.add(obs.requests.PlayPauseMedia(sourceName=preroll_name, playPause=True))
+            batch.add(obs.requests.SetMediaTime(sourceName=preroll_name, timestamp=0))
+            batch.execute(self.client)
+            if batch.failed_keys():
+                self.delete_source_if_exist(preroll_name, scene_name)
+                raise RuntimeError(f"OBS::preroll_media(): couldn't pause the media, path: {path}")
+
+            self._prerolled[source_name] = (path, preroll_name, scene_name)
+
+    def drop_preroll(self, source_name=None):
+        """
+        Removes the media pre-rolled, if any
+        """
+        if not source_name:
+            source_name = OBS.MAIN_MEDIA_NAME
+
+        with self._preroll_lock:
+            prerolled = self._prerolled.pop(source_name, None)
+            if prerolled is not None:
+                _, preroll_name, scene_name = prerolled
+                self.delete_source_if_exist(preroll_name, scene_name)
+
+    def _show_preroll(self, path, source_name) -> bool:
+        """
+        Shows the media pre-rolled in place of the media playing with a single batch.
+        Returns False if `path` has not been pre-rolled
+        """
+        with self._preroll_lock:
+            prerolled = self._prerolled.get(source_name)
+            if prerolled is None or prerolled[0] != path:
+                return False
+            _, preroll_name, scene_name = self._prerolled.pop(source_name)
+
+            batch = RequestBatch()
+            batch.add(obs.requests.SetSceneItemProperties(item=preroll_name, scene_name=scene_name, visible=True))
+            batch.add(obs.requests.SetMute(source=preroll_name, mute=False))
+            batch.add(obs.requests.PlayPauseMedia(sourceName=preroll_name, playPause=False))
+            batch.execute(self.client)
+            if batch.failed_keys():
+                self.delete_source_if_exist(preroll_name, scene_name)
+                return False
+
+            self.delete_source_if_exist(self.media_source_name(source_name), scene_name)  # media played before
+            self._media_sources[source_name] = preroll_name
+        return True
 
     def stop_media(self, source_name=None):
         """
@@ -210,7 +339,7 @@ class OBS:
             source_name = self.MAIN_MEDIA_NAME
 
         self._current_media_played = None
-        self.delete_source_if_exist(source_name=source_name)
+        self.delete_source_if_exist(source_name=self.media_source_name(source_name))
         self.delete_source_if_exist(source_name=OBS.TRANSITION_INPUT_NAME)
         self.media_cb_thread.delete_cb_type(cb_type=source_name)
 
@@ -301,7 +430,22 @@ class OBS:
         if not response.status:
             raise RuntimeError(f"OBS::reorder_inputs(): datain {response.datain}, dataout: {response.dataout}")
 
-        existing_items = [item['sourceName'] for item in response.getSceneItems()]
+        items = OBS._reorder_items(response.getSceneItems(), source_names)
+        try:
+            response = self.client.call(
+                obs.requests.ReorderSceneItems(items, scene=OBS.MAIN_SCENE_NAME)
+            )
+            if not response.status:
+                raise RuntimeError(f"OBS::reorder_inputs(): datain {response.datain}, dataout: {response.dataout}")
+        except:
+            pass
+
+    @staticmethod
+    def _reorder_items(scene_items, source_names):
+        """
+        Returns ReorderSceneItems items: `source_names` present in the scene first, then the rest of the scene
+        """
+        existing_items = [item['sourceName'] for item in scene_items]
         ordered_items = []
 
         for source_name in source_names:
@@ -312,13 +456,44 @@ class OBS:
             if source_name not in ordered_items:
                 ordered_items.append(source_name)
 
-        items = [{'name': source_name} for source_name in ordered_items]
+        return [{'name': source_name} for source_name in ordered_items]
+
+    # Awaitable operations, to be awaited on the event loop of OBSClient (see OBSClient.run()).
+    # Single-request operations are awaited natively, so concurrent ones are pipelined on the connection.
+    # Media operations manage the pre-roll and the media callbacks, which are thread-based,
+    # so they are awaited in a worker thread
+
+    async def run_media_async(self, path, **kwargs):
+        """
+        Awaitable run_media(), see run_media() for the parameters
+        """
+        await self.client.run_in_thread(self.run_media, path, **kwargs)
+
+    async def stop_media_async(self, source_name=None):
+        """
+        Awaitable stop_media()
+        """
+        await self.client.run_in_thread(self.stop_media, source_name)
+
+    async def set_mute_async(self, source_name, mute):
+        """
+        Awaitable set_mute()
+        """
+        response = await self.client.call_async(obs.requests.SetMute(source=source_name, mute=mute))
+        if not response.status:
+            raise RuntimeError(f"OBS::set_mute_async(): datain: {response.datain}, dataout: {response.dataout}")
+
+    async def reorder_inputs_async(self, source_names):
+        """
+        Awaitable reorder_inputs()
+        """
+        response = await self.client.call_async(obs.requests.GetSceneItemList(OBS.MAIN_SCENE_NAME))
+        if not response.status:
+            raise RuntimeError(f"OBS::reorder_inputs_async(): datain {response.datain}, dataout: {response.dataout}")
+
+        items = OBS._reorder_items(response.getSceneItems(), source_names)
         try:
-            response = self.client.call(
-                obs.requests.ReorderSceneItems(items, scene=OBS.MAIN_SCENE_NAME)
-            )
-            if not response.status:
-                raise RuntimeError(f"OBS::reorder_inputs(): datain {response.datain}, dataout: {response.dataout}")
+            await self.client.call_async(obs.requests.ReorderSceneItems(items, scene=OBS.MAIN_SCENE_NAME))
         except:
             pass
 
@@ -403,7 +578,14 @@ class OBS:
         #         pass
         # except BaseException as ex:
         #     print(f"E PYSERVER::OBS::on_event(): {ex}")
-        pass
+        try:
+            if message.name == "SwitchScenes":  # media pre-rolled in another scene would never be shown
+                scene_name = message.datain.get("scene-name")
+                for source_name, (_, _, preroll_scene_name) in list(self._prerolled.items()):
+                    if preroll_scene_name != scene_name:
+                        self.drop_preroll(source_name)
+        except BaseException as ex:
+            print(f"E PYSERVER::OBS::on_event(): {ex}")
 
     def obsws_get_current_scene_name(self):
         return self.client.call(obs.requests.GetCurrentScene()).getName()
@@ -426,3 +608,85 @@ class OBS:
         :return: list of [... {'itemId': n, 'sourceKind': '...', 'sourceName': '...', 'sourceType': '...'}, ...]
         """
         return self.client.call(obs.requests.GetSceneItemList(sceneName=scene_name)).getSceneItems()
+
+
+class ExecuteBatch(Baserequests):
+    """
+    obs-websocket (>= 4.9) ExecuteBatch request, which obs-websocket-py doesn't provide. Executes
+    `requests` in a single round trip, every request of the batch is populated with its own response
+    """
+
+    def __init__(self, requests, abort_on_fail=False):
+        Baserequests.__init__(self)
+        self.name = "ExecuteBatch"
+        self._requests = {str(i): request for i, request in enumerate(requests)}  # message-id: request
+        self.dataout["requests"] = [
+            {**request.data(), "message-id": message_id} for message_id, request in self._requests.items()
+        ]
+        self.dataout["abortOnFail"] = abort_on_fail
+
+    def input(self, data):
+        Baserequests.input(self, data)
+        for result in self.datain.get("results", []):
+            request = self._requests.get(str(result.get("message-id")))
+            if request is not None:
+                request.input(result)
+
+
+class RequestBatch:
+    """
+    Collects obs-websocket requests and executes them with a single ExecuteBatch.
+    Falls back to sequential calls if obs doesn't support ExecuteBatch
+    """
+
+    _unsupported = weakref.WeakSet()  # clients whose obs has rejected ExecuteBatch as an unknown request
+
+    def __init__(self):
+        self.requests = []  # [... (request, key), ...]
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, request, key=None):
+        """
+        :param key: optional tag of the request (e.g. an input name), see failed_keys()
+        :return: the request, which is populated with the response after execute()
+        """
+        self.requests.append((request, key))
+        return request
+
+    def execute(self, client) -> int:
+        """
+        Executes the requests in the order they have been added. Returns the number of round trips made
+        """
+        requests = [request for request, _ in self.requests]
+        if not requests:
+            return 0
+        if len(requests) > 1 and RequestBatch.supported(client):
+            batch = client.call(ExecuteBatch(requests))
+            if batch.status:
+                return 1
+            if "invalid request type" in str(batch.datain.get("error", "")).lower():  # obs-websocket < 4.9
+                RequestBatch.set_supported(client, False)
+                print(f"W PYSERVER::RequestBatch::execute(): ExecuteBatch is not supported, details: {batch.datain}")
+            for request in requests:
+                client.call(request)
+            return len(requests) + 1
+        for request in requests:
+            client.call(request)
+        return len(requests)
+
+    @staticmethod
+    def supported(client) -> bool:
+        return client not in RequestBatch._unsupported
+
+    @staticmethod
+    def set_supported(client, supported):
+        if supported:
+            RequestBatch._unsupported.discard(client)
+        else:
+            RequestBatch._unsupported.add(client)
+
+    def failed_keys(self) -> set:
+        """Returns keys of the requests which have failed"""
+        return {key for request, key in self.requests if not request.status}
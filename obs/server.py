@@ -1,4 +1,5 @@
-import glob
+import collections
+import math
 import os
 import re
 import json
@@ -15,6 +16,9 @@ from typing import List, Dict
 import threading
 
 from obs import OBS
+from obs.obs import RequestBatch
+from obs.client import OBSClient
+from obs.media import MediaIndex, media_num
 from threading import RLock
 from util import ExecutionStatus
 from models import MinionSettings
@@ -25,6 +29,20 @@ BASE_MEDIA_DIR = os.getenv("MEDIA_DIR", "./content")
 # DEFAULT_API_KEY = os.getenv("GDRIVE_API_KEY", "")
 # DEFAULT_SYNC_SECONDS = int(os.getenv("GDRIVE_SYNC_SECONDS", 60))
 MEDIA_DIR = os.path.join(BASE_MEDIA_DIR, "media")
+# the cached state of obs is dropped and everything is re-checked against obs every OBS_FULL_RESYNC_SECONDS
+OBS_FULL_RESYNC_SECONDS = float(os.getenv("OBS_FULL_RESYNC_SECONDS", 60))
+# drift in obs is corrected on obs events, the periodic sync is only a safety sweep running every OBS_SWEEP_SECONDS
+OBS_SWEEP_SECONDS = float(os.getenv("OBS_SWEEP_SECONDS", 15))
+OBS_RETRY_SECONDS = 3  # the sync is retried this often while it fails (e.g. obs is not reachable)
+# armed timing cues are pre-rolled (see OBS.preroll_media()) this many seconds ahead, 0 - disables the pre-roll
+MEDIA_PREROLL_SECONDS = float(os.getenv("MEDIA_PREROLL_SECONDS", 5))
+MEDIA_PREROLL_AFTER_SHOWN_SECONDS = 0.5  # gap between showing the media of a cue and pre-rolling the next one
+CUE_FIRES_KEPT = 100  # number of the last armed cues fired kept for 'get sync stats', see OBSController.cue_stats()
+# subjects of MinionSettings which are a part of the desired state of the corresponding obs inputs
+TEAMSPEAK_SOURCE_SUBJECTS = {"ts_volume", "ts_gain_settings", "ts_limiter_settings"}
+MAIN_STREAM_SOURCE_SUBJECTS = {"addr_config", "source_volume", "sidechain_settings"}
+# OBSController.apply_patch() fails with this reason until the whole config has been applied by apply_info()
+PATCH_NEEDS_FULL_CONFIG = "needs full config"
 
 
 class OBSFilter(BaseModel):
@@ -62,35 +80,205 @@ class OBSConfig(BaseModel):
 
 
 class OBSMonitoring:
-    def __init__(self, obs, obs_wrapper, obs_controller):
+    def __init__(self, obs, obs_wrapper, obs_controller, run_monitoring=True):
+        """
+        :param run_monitoring: if False, the monitoring thread is not started and sync() has to be called manually
+        """
         self.obs_config = OBSConfig()
         self.obs = obs
         self.obs_wrapper: OBS = obs_wrapper
         self.obs_controller = obs_controller
 
+        # Last known state of the inputs in obs: source_name: OBSInput, as it has been synced. It is updated
+        # by our own writes and by obs events, and is dropped on reconnection and every OBS_FULL_RESYNC_SECONDS.
+        # Only the fields differing from it are synced
+        self._synced: Dict[str, OBSInput] = {}
+        # Bumped by invalidate(). A sync caches an input only if its generation hasn't changed since the sync
+        # has read it, so that an invalidation by an event arrived in the middle of the sync is not lost
+        self._generations: Dict[str, int] = {}  # source_name: generation
+        self._epoch = 0  # generation of the whole cache
+        self._cache_lock = threading.Lock()
+        self._last_full_sync = time.monotonic()
+        self.calls_avoided = 0  # obs-websocket calls skipped thanks to the cache
+        self.full_resyncs = 0
+        self.targeted_syncs = 0
+        self.syncs = 0
+        self.round_trips = 0
+        self.requests_sent = 0
+        self.last_sync_ms = None
+        self.total_sync_ms = 0.0
+        # inputs which have drifted from obs_config according to obs events, see _on_event()
+        self._dirty = set()
+        self._dirty_all = False  # the whole sync is needed (e.g. the scene has been switched)
+        self._dirty_cond = threading.Condition()
+
         self.sync_lock = threading.RLock()
+        self.obs.register(self._on_event)
         self.monitoring_thread = threading.Thread(target=self.monitoring)
-        self.monitoring_thread.start()
+        if run_monitoring:
+            self.monitoring_thread.start()
 
         # self.media_cb_thread = CallbackThread()
         # self.media_cb_thread.start()
 
     def monitoring(self):
+        last_sweep, failed = float("-inf"), False  # the first sweep runs right away
         while True:
+            timeout = OBS_RETRY_SECONDS if failed else max(last_sweep + OBS_SWEEP_SECONDS - time.monotonic(), 0)
+            with self._dirty_cond:
+                if not self._dirty and not self._dirty_all:
+                    self._dirty_cond.wait(timeout)
+                dirty, self._dirty = self._dirty, set()
+                dirty_all, self._dirty_all = self._dirty_all, False
             try:
-                self.sync()
+                if dirty_all or failed or time.monotonic() - last_sweep >= OBS_SWEEP_SECONDS:
+                    last_sweep = time.monotonic()
+                    self.sync()
+                elif dirty:
+                    self.sync_inputs(dirty)
+                failed = False
             except Exception as ex:
                 print(f"Monitoring error: {ex}")
-            time.sleep(3)
+                failed = True
 
     def sync(self):
+        """
+        Syncs obs with obs_config in two round trips: one batch of reads and one batch of writes
+        """
         with self.sync_lock:
+            if time.monotonic() - self._last_full_sync >= OBS_FULL_RESYNC_SECONDS:
+                self.invalidate()
             self._check_configs()
             self._check_connection()
-            self._sync_scene()
             self._sync_inputs()
             self._sync_playing_media()
 
+    def sync_inputs(self, source_names):
+        """
+        Syncs only the inputs specified (those which are not in obs_config are skipped)
+        """
+        with self.sync_lock:
+            self._check_configs()
+            self._sync_inputs([source_name for source_name in source_names if source_name in self.obs_config.inputs])
+            self.targeted_syncs += 1
+
+    async def sync_inputs_async(self, source_names):
+        """
+        Awaitable sync_inputs() (inputs and their filters), to be awaited on the event loop of OBSClient
+        """
+        await self.obs.run_in_thread(self.sync_inputs, source_names)
+
+    def _mark_dirty(self, source_name=None):
+        """Wakes up the monitoring to sync the input `source_name` (everything, if not specified)"""
+        with self._dirty_cond:
+            if source_name is None:
+                self._dirty_all = True
+            else:
+                self._dirty.add(source_name)
+            self._dirty_cond.notify()
+
+    def invalidate(self, source_name=None):
+        """
+        Drops the cached state of the input `source_name` (of all the inputs, if not specified),
+        so that it is fully re-checked against obs by the next sync()
+        """
+        with self._cache_lock:
+            if source_name is not None:
+                self._synced.pop(source_name, None)
+                self._generations[source_name] = self._generations.get(source_name, 0) + 1
+                return
+            self._synced = {}
+            self._epoch += 1
+        self._last_full_sync = time.monotonic()
+        self.full_resyncs += 1
+
+    def stats(self) -> dict:
+        return {
+            "calls_avoided": self.calls_avoided,
+            "full_resyncs": self.full_resyncs,
+            "targeted_syncs": self.targeted_syncs,
+            "cached_inputs": list(self._synced.keys()),
+            "syncs": self.syncs,
+            "round_trips": self.round_trips,
+            "requests_sent": self.requests_sent,
+            "last_sync_ms": self.last_sync_ms,
+            "avg_sync_ms": round(self.total_sync_ms / self.syncs, 3) if self.syncs else None,
+        }
+
+    def _on_event(self, event):
+        # Called from the thread of obs-websocket-py. Keeps the cached state in line with changes made
+        # to obs by anyone, and if obs has drifted from obs_config - wakes up the monitoring to fix
+        # the input right away. Our own writes match obs_config, so they are just confirmed
+        try:
+            data = event.datain
+            source_name = data.get("sourceName") or data.get("item-name")
+            desired: OBSInput = self.obs_config.inputs.get(source_name) if source_name else None
+            cached = False
+            dirty = False
+
+            if event.name == "SourceMuteStateChanged":
+                def update(synced: OBSInput):
+                    synced.is_muted = data["muted"]
+
+                cached = self._update_cached(source_name, update)
+                dirty = desired is not None and desired.is_muted != data["muted"]
+            elif event.name == "SourceVolumeChanged":
+                volume = data["volume"]  # multiplier
+                volume_db = 20 * math.log10(volume) if volume > 0 else float("-inf")
+
+                def update(synced: OBSInput):
+                    if abs(volume_db - synced.volume) > 0.01:
+                        synced.volume = volume_db
+
+                cached = self._update_cached(source_name, update)
+                dirty = desired is not None and abs(volume_db - desired.volume) > 0.01
+            elif event.name == "SourceFilterVisibilityChanged":
+                filter_name = data["filterName"]
+
+                def update(synced: OBSInput):
+                    if filter_name in synced.filters:
+                        synced.filters[filter_name].enabled = data["filterEnabled"]
+
+                cached = self._update_cached(source_name, update)
+                dirty = desired is not None and filter_name in desired.filters and \
+                    desired.filters[filter_name].enabled != data["filterEnabled"]
+            elif event.name == "SourceFilterAdded":
+                self.invalidate(source_name)
+                dirty = desired is not None and data["filterName"] not in desired.filters
+            elif event.name in ("SourceFilterRemoved", "SourceFiltersReordered", "SourceDestroyed",
+                                "SourceAudioMixersChanged", "SceneItemRemoved"):
+                self.invalidate(source_name)
+                dirty = desired is not None
+            elif event.name == "SourceCreated":
+                self.invalidate(source_name)
+            elif event.name == "SourceRenamed":
+                for name in (data.get("previousName"), data.get("newName")):
+                    self.invalidate(name)
+                    if name in self.obs_config.inputs:
+                        self._mark_dirty(name)
+            elif event.name == "SwitchScenes":
+                if data.get("scene-name") != self.obs_config.scene:
+                    self._mark_dirty()
+
+            if dirty:
+                if not cached:  # the input may be being synced, don't let the sync cache what it has read
+                    self.invalidate(source_name)
+                self._mark_dirty(source_name)
+        except Exception as ex:
+            print(f"E PYSERVER::OBSMonitoring::_on_event(): {ex}")
+
+    def _update_cached(self, source_name, update) -> bool:
+        """
+        Applies an event delta, update(cached OBSInput), to the cached state of the input under the cache lock.
+        Returns False if the input is not cached (e.g. it is being synced right now)
+        """
+        with self._cache_lock:
+            synced = self._synced.get(source_name) if source_name else None
+            if synced is None:
+                return False
+            update(synced)
+            return True
+
     def _check_configs(self):
         if OBS.MAIN_STREAM_SOURCE_NAME in self.obs_config.inputs and \
                 OBS.TEAMSPEAK_SOURCE_NAME in self.obs_config.inputs:
@@ -118,100 +306,195 @@ class OBSMonitoring:
 
     def _check_connection(self):
         try:
-            if not self.obs.ws or not self.obs.ws.connected:
+            if not self.obs.connected:
                 self.obs.connect()
+                self.invalidate()  # obs could have been restarted, the cached state is not valid anymore
         except Exception as ex:
             raise ConnectionError(f"Couldn't connect to OBS: {ex}")
 
-        try:  # check connection by sending a simple request
-            response = self.obs.call(obsws.requests.GetCurrentScene())
-            if not response.status:
-                raise Exception(f"Couldn't check connection. Details: {response.dataout}")
-        except Exception as ex:  # if connection is broken - disconnect and try again
-            self.obs.disconnect()
-            raise ex
+    def _call(self, request):
+        self.round_trips += 1
+        self.requests_sent += 1
+        return self.obs.call(request)
 
-    def _sync_scene(self):
-        current_scene = self.obs.call(obsws.requests.GetCurrentScene()).getName()
+    def _execute(self, batch: RequestBatch):
+        self.round_trips += batch.execute(self.obs)
+        self.requests_sent += len(batch)
+
+    def _sync_scene(self, current_scene):
         if current_scene != self.obs_config.scene:
             # [... {'name': '...', 'sources': [...]}, ...]
-            scenes = self.obs.call(obsws.requests.GetSceneList()).getScenes()
+            scenes = self._call(obsws.requests.GetSceneList()).getScenes()
 
             # if such scene doesn't exist, create
             if all([x["name"] != self.obs_config.scene for x in scenes]):
-                self.obs.call(obsws.requests.CreateScene(sceneName=self.obs_config.scene))
-
-            self.obs.call(obsws.requests.SetCurrentScene(scene_name=self.obs_config.scene))
-
-    def _sync_inputs(self):
-        scene_items = self.obs.call(obsws.requests.GetSceneItemList(sceneName=self.obs_config.scene)).getSceneItems()
-
-        # delete scene items which doesn't exist in configs
-        for scene_item in scene_items:
-            source_name = scene_item["sourceName"]
-            if source_name not in self.obs_config.inputs:
-                # pass
-                if source_name not in ("Desktop Audio", OBS.MAIN_MEDIA_NAME) and \
-                        not source_name.startswith(OBS.MAIN_MEDIA_NAME):
-                    self.obs.call(obsws.requests.DeleteSceneItem(item=source_name, scene=self.obs_config.scene))
-        # sync all inputs
-        for source_name in self.obs_config.inputs.keys():
-            self._sync_input(source_name)
-
-    def _sync_input(self, source_name):
+                self._call(obsws.requests.CreateScene(sceneName=self.obs_config.scene))
+
+            self._call(obsws.requests.SetCurrentScene(scene_name=self.obs_config.scene))
+
+    def _sync_inputs(self, source_names=None):
+        """
+        Reads the state of the inputs which are not cached with one batch, and writes the differences
+        with another one
+        :param source_names: inputs to sync, if None - the scene and all the inputs are synced,
+                             and the scene items which are not in obs_config are deleted
+        """
+        t = time.monotonic()
+        full = source_names is None
+        if full:
+            source_names = list(self.obs_config.inputs.keys())
+        with self._cache_lock:
+            synced = {source_name: self._synced.pop(source_name, None) for source_name in source_names}
+            generations = {source_name: (self._epoch, self._generations.get(source_name, 0))
+                           for source_name in source_names}
+
+        reads = RequestBatch()
+        # the first request also checks the connection
+        current_scene_request = reads.add(obsws.requests.GetCurrentScene())
+        scene_items_request = reads.add(obsws.requests.GetSceneItemList(sceneName=self.obs_config.scene))
+        settings_requests, filters_requests = {}, {}
+        for source_name in source_names:
+            input_, synced_ = self.obs_config.inputs[source_name], synced[source_name]
+            if synced_ is not None and synced_.source_kind == input_.source_kind and \
+                    synced_.source_settings == input_.source_settings:
+                self.calls_avoided += 1  # GetSourceSettings
+            else:
+                settings_requests[source_name] = reads.add(obsws.requests.GetSourceSettings(sourceName=source_name))
+            if synced_ is not None and self._filters_settings_equal(synced_.filters, input_.filters):
+                self.calls_avoided += 1  # GetSourceFilters
+            else:
+                filters_requests[source_name] = reads.add(obsws.requests.GetSourceFilters(source_name))
+        try:
+            self._execute(reads)
+            if not current_scene_request.status:
+                raise Exception(f"Couldn't check connection. Details: {current_scene_request.datain}")
+        except Exception as ex:  # if connection is broken - disconnect and try again
+            self.obs.disconnect()
+            raise ex
+
+        if full:
+            self._sync_scene(current_scene_request.getName())
+
+        scene_items = scene_items_request.getSceneItems() if scene_items_request.status else []
+        scene_item_names = [scene_item["sourceName"] for scene_item in scene_items]
+
+        writes = RequestBatch()
+        if full:
+            # delete scene items which doesn't exist in configs
+            for source_name in scene_item_names:
+                if source_name not in self.obs_config.inputs:
+                    if source_name not in ("Desktop Audio", OBS.MAIN_MEDIA_NAME) and \
+                            not source_name.startswith(OBS.MAIN_MEDIA_NAME):
+                        writes.add(obsws.requests.DeleteSceneItem(item=source_name, scene=self.obs_config.scene))
+        for source_name in source_names:
+            self._sync_input(source_name, scene_item_names, synced[source_name], writes,
+                             settings_request=settings_requests.get(source_name),
+                             filters_request=filters_requests.get(source_name))
+        self._execute(writes)
+
+        # cache the inputs which have been synced successfully
+        failed = writes.failed_keys()
+        with self._cache_lock:
+            for source_name in source_names:
+                invalidated = generations[source_name] != (self._epoch, self._generations.get(source_name, 0))
+                if source_name not in failed and not invalidated:
+                    self._synced[source_name] = self.obs_config.inputs[source_name].copy(deep=True)
+
+        self.syncs += 1
+        self.last_sync_ms = round((time.monotonic() - t) * 1000, 3)
+        self.total_sync_ms += self.last_sync_ms
+
+    def _sync_input(self, source_name, scene_item_names, synced: OBSInput, writes: RequestBatch,
+                    settings_request=None, filters_request=None):
+        """
+        Adds the requests needed to sync the input to `writes`
+        :param scene_item_names: source names of the scene items
+        :param synced: cached state of the input, None - unknown
+        :param settings_request: GetSourceSettings executed, None - the settings are equal to the cached ones
+        :param filters_request: GetSourceFilters executed, None - the filters are equal to the cached ones
+        """
         input_: OBSInput = self.obs_config.inputs[source_name]
         if not input_.scene_name:
             input_.scene_name = "main"
 
-        if source_name != "Desktop Audio" and not self._source_exists(source_name):
-            self.obs.call(
+        if source_name != "Desktop Audio" and source_name not in scene_item_names:
+            synced = None
+            writes.add(
                 obsws.requests.CreateSource(
                     sourceName=source_name,
                     sourceKind=input_.source_kind,
                     sceneName=input_.scene_name,
                     sourceSettings=input_.source_settings,
-                )
+                ),
+                key=source_name,
             )
-        else:
-            response = self.obs.call(obsws.requests.GetSourceSettings(sourceName=source_name))
-            source_type = response.getSourceType()
-            source_settings = response.getSourceSettings()
+        elif settings_request is not None:
+            source_type = settings_request.getSourceType() if settings_request.status else None
+            source_settings = settings_request.getSourceSettings() if settings_request.status else None
 
             # if settings are different -> synchronize
             if not self._settings_equal(input_.source_kind, source_type,
                                         input_.source_settings, source_settings):
-                # if json.dumps({"source_kind": source_type, "source_settings": source_settings}) != \
-                #         json.dumps({"source_kind": input_.source_kind, "source_settings": input_.source_settings}):
-                self.obs.call(
+                writes.add(
                     obsws.requests.SetSourceSettings(sourceName=source_name,
                                                      sourceSettings=input_.source_settings,
-                                                     sourceType=input_.source_kind)
+                                                     sourceType=input_.source_kind),
+                    key=source_name,
                 )
 
-        self._sync_filters(source_name)
-        self._sync_volume(source_name)
-        self._sync_mute(source_name)
-        self._sync_monitor_type(source_name)
+        if filters_request is None and synced is not None:
+            for filter_name, filter_ in input_.filters.items():  # only visibility of the filters may differ
+                if synced.filters[filter_name].enabled != filter_.enabled:
+                    self._sync_filter_visibility(source_name, filter_name, writes)
+                else:
+                    self.calls_avoided += 1
+        else:
+            filters = filters_request.getFilters() if filters_request is not None and filters_request.status else []
+            self._sync_filters(source_name, filters, writes)
+
+        for field, sync_field in (
+                ("volume", self._sync_volume),
+                ("is_muted", self._sync_mute),
+                ("monitor_type", self._sync_monitor_type),
+        ):
+            if synced is not None and getattr(synced, field) == getattr(input_, field):
+                self.calls_avoided += 1
+            else:
+                sync_field(source_name, writes)
 
-    def _sync_filters(self, source_name):
+    @staticmethod
+    def _filters_settings_equal(filters_a: Dict[str, OBSFilter], filters_b: Dict[str, OBSFilter]):
+        """Compares filters ignoring their visibility"""
+        if filters_a.keys() != filters_b.keys():
+            return False
+        return all(
+            filters_a[name].filter_type == filters_b[name].filter_type
+            and filters_a[name].filter_settings == filters_b[name].filter_settings
+            for name in filters_a
+        )
+
+    def _sync_filters(self, source_name, filters, writes: RequestBatch):
+        """
+        :param filters: filters of the input in obs, returned by GetSourceFilters
+        """
         input_ = self.obs_config.inputs[source_name]
-        filters = self.obs.call(obsws.requests.GetSourceFilters(source_name)).getFilters()
 
         for filter_ in filters:  # iterate all filters on the input
             filter_name = filter_["name"]
             if filter_name not in input_.filters:  # if such filter doesn't exist in config -> remove
-                self.obs.call(obsws.requests.RemoveFilterFromSource(source_name, filter_name))
+                writes.add(obsws.requests.RemoveFilterFromSource(source_name, filter_name), key=source_name)
 
         for filter_name in input_.filters:  # iterate through config filters
             filter_: OBSFilter = input_.filters[filter_name]
             if filter_name not in [f["name"] for f in filters]:  # if such filter doesn't exist yet -> create
-                self.obs.call(
+                writes.add(
                     obsws.requests.AddFilterToSource(
                         sourceName=source_name,
                         filterName=filter_name,
                         filterType=filter_.filter_type,
                         filterSettings=filter_.filter_settings,
-                    )
+                    ),
+                    key=source_name,
                 )
             else:  # if such filter already exists -> check it
                 existing_filter = [f for f in filters if f["name"] == filter_name][0]
@@ -223,41 +506,54 @@ class OBSMonitoring:
                 }
                 if not self._settings_equal("sidechain", "sidechain", filter_dict, existing_filter):
                     # if json.dumps(existing_filter) != json.dumps(filter_dict):  # if settings are differing
-                    self.obs.call(obsws.requests.SetSourceFilterSettings(  # synchronise them
+                    writes.add(obsws.requests.SetSourceFilterSettings(  # synchronise them
                         sourceName=source_name, filterName=filter_name, filterSettings=filter_.filter_settings,
-                    ))
+                    ), key=source_name)
 
-            self.obs.call(
-                obsws.requests.SetSourceFilterVisibility(
-                    sourceName=source_name, filterName=filter_name, filterEnabled=filter_.enabled,
-                )
-            )
+            self._sync_filter_visibility(source_name, filter_name, writes)
 
-    def _sync_volume(self, source_name):
+    def _sync_filter_visibility(self, source_name, filter_name, writes: RequestBatch):
+        filter_: OBSFilter = self.obs_config.inputs[source_name].filters[filter_name]
+
+        writes.add(
+            obsws.requests.SetSourceFilterVisibility(
+                sourceName=source_name, filterName=filter_name, filterEnabled=filter_.enabled,
+            ),
+            key=source_name,
+        )
+
+    def _sync_volume(self, source_name, writes: RequestBatch):
         input_: OBSInput = self.obs_config.inputs[source_name]
 
-        self.obs.call(
-            obsws.requests.SetVolume(source=source_name, volume=input_.volume, useDecibel=True)
+        writes.add(
+            obsws.requests.SetVolume(source=source_name, volume=input_.volume, useDecibel=True),
+            key=source_name,
         )
 
-    def _sync_mute(self, source_name):
+    def _sync_mute(self, source_name, writes: RequestBatch):
         input_: OBSInput = self.obs_config.inputs[source_name]
 
-        self.obs.call(
-            obsws.requests.SetMute(source=source_name, mute=input_.is_muted)
+        writes.add(
+            obsws.requests.SetMute(source=source_name, mute=input_.is_muted),
+            key=source_name,
         )
 
-    def _sync_monitor_type(self, source_name):
+    def _sync_monitor_type(self, source_name, writes: RequestBatch):
         input_: OBSInput = self.obs_config.inputs[source_name]
 
-        self.obs.call(obsws.requests.SetAudioMonitorType(sourceName=source_name,
-                                                         monitorType=input_.monitor_type))
+        writes.add(
+            obsws.requests.SetAudioMonitorType(sourceName=source_name, monitorType=input_.monitor_type),
+            key=source_name,
+        )
 
     def _sync_playing_media(self):
         with self.obs_config.media_lock:
-            if self.obs_config and self.obs_config.playing_media_name and not self._source_exists(OBS.MAIN_MEDIA_NAME):
+            if not self.obs_config or not self.obs_config.playing_media_name:
+                return
+            media_name = self.obs_wrapper.media_source_name(OBS.MAIN_MEDIA_NAME)
+            if not self._source_exists(media_name):
                 self.obs_wrapper._run_media(self.obs_config.playing_media_name,
-                                            OBS.MAIN_MEDIA_NAME,
+                                            media_name,
                                             timestamp=(time.time() - self.obs_config.playing_media_ts) * 1000)
 
     def _source_exists(self, source_name):
@@ -270,7 +566,7 @@ class OBSMonitoring:
         """
         Returns (item_id, scene_name) given a source_name
         """
-        items = self.obs.call(obsws.requests.GetSceneItemList(sceneName=self.obs_config.scene)).getSceneItems()
+        items = self._call(obsws.requests.GetSceneItemList(sceneName=self.obs_config.scene)).getSceneItems()
         for item in items:
             item_id, source_name_ = item["itemId"], item["sourceName"]
             if source_name_ == source_name:
@@ -309,12 +605,22 @@ class OBSMonitoring:
         if mode not in (OBS.PLAYBACK_MODE_FORCE, OBS.PLAYBACK_MODE_CHECK_ANY, OBS.PLAYBACK_MODE_CHECK_SAME):
             return ExecutionStatus(status=False, message="invalid `mode`")
 
+        status = self.find_media(name=name, media_dir=media_dir, search_by_num=search_by_num)
+        if not status.serializable_object:
+            return status
+        return self.run_media_path(status.serializable_object, mode=mode)
+
+    def find_media(self, name, media_dir, search_by_num=True) -> ExecutionStatus:
+        """
+        Resolves media file path by name.
+        :return: ExecutionStatus(), serializable_object - the path found or None
+        """
         status = ExecutionStatus(status=True)
 
         # search for the file
         if search_by_num:
             # extract file number
-            file_num = re.search(r"(?P<file_num>[\d\.]+)_.", name)
+            file_num = media_num(name)
             if not file_num:  # if the pattern is incorrect (name doesn't start with numbers)
                 status.append_error(
                     f"Server::run_media(): while `use_file_num` is set, "
@@ -322,20 +628,29 @@ class OBSMonitoring:
                 )
                 return status
             else:
-                file_num = file_num.group("file_num")
-
-                files = glob.glob(os.path.join(media_dir, f"{file_num}_*"))  # find those files
-                if len(files) == 0:  # if no media found with name specified
+                media_index: MediaIndex = self.obs_controller.media_index
+                media_index.set_media_dir(media_dir)
+                media_file = media_index.find(file_num)
+                if media_file is None:  # if no media found with name specified
                     status.append_warning(f"Server::run_media(): no media found, name {name}")
                     return status
                 else:
-                    path = files[0]
+                    path = media_file.path
         else:
             path = os.path.join(media_dir, name)
             if not os.path.isfile(path):
                 status.append_warning(f"Server::run_media(): no media found with name specified, name {name}")
                 return status
 
+        status.serializable_object = path
+        return status
+
+    def run_media_path(self, path, mode) -> ExecutionStatus:
+        """
+        Plays media file already resolved by `find_media()`
+        """
+        status = ExecutionStatus(status=True)
+
         try:
             def on_start(filename, duration):
                 with self.obs_config.media_lock:
@@ -360,7 +675,8 @@ class OBSMonitoring:
 
             self.obs_wrapper.run_media(
                 path, mode=mode, source_name=OBS.MAIN_MEDIA_NAME,
-                on_start=on_start, on_error=on_finish, on_finish=on_finish
+                on_start=on_start, on_error=on_finish, on_finish=on_finish,
+                duration=self.obs_controller.media_index.duration(path),
             )
         except BaseException as ex:
             status.append_error(f"Server::run_media(): couldn't play media. Details: {ex}")
@@ -392,16 +708,21 @@ class OBSController:
     def __init__(self):
         self.minion_settings = MinionSettings.default()
 
-        self.obs_ws: obsws.obsws = None
+        self.obs_ws: OBSClient = None
         self.obs_instance: OBS = None
         self.obs_monitoring: OBSMonitoring = None
         self.obs_connected = False
         self.is_initialized = False
+        self.has_full_config = False  # apply_info() has succeeded, so patches can be applied on top of it
 
         self.media_dir = MEDIA_DIR
+        self.media_index = MediaIndex(MEDIA_DIR)  # file number -> media file, see find_media()
 
         self.media_cb_thread = CallbackThread()
         self.media_cb_thread.start()
+        self.cue_cb_thread = CallbackThread()  # armed timing cues, see arm_cues()
+        self.cue_cb_thread.start()
+        self._cue_fires = collections.deque(maxlen=CUE_FIRES_KEPT)  # the last cues fired, see cue_stats()
 
     def apply_info(self, minion_settings: MinionSettings):
         self.minion_settings.modify_from(other=minion_settings)
@@ -413,10 +734,50 @@ class OBSController:
                 return status
 
             self.activate()
+            self.has_full_config = True
         except BaseException as ex:
             status.append_error(f"Server::apply_info(): Couldn't activate settings. Details: {ex}")
         return status
 
+    def apply_patch(self, patch: dict):
+        """
+        Applies the output of MinionSettings.patch() and runs only the activation steps of the subjects
+        changed. Fails with PATCH_NEEDS_FULL_CONFIG without applying anything if the whole config has not
+        been applied yet (e.g. the minion has been restarted), then the config has to be sent with apply_info()
+        """
+        if not self.is_initialized or not self.has_full_config:
+            return ExecutionStatus(status=False, message=PATCH_NEEDS_FULL_CONFIG)
+        self.minion_settings.apply_patch(patch)
+
+        status = ExecutionStatus(status=True)
+        try:
+            subjects = set(patch.keys())
+            # these subjects are applied by the monitoring, as the desired state of the obs inputs
+            if subjects & TEAMSPEAK_SOURCE_SUBJECTS:
+                self._spawn_teamspeak_source()
+            if subjects & MAIN_STREAM_SOURCE_SUBJECTS:
+                self._spawn_main_stream_source()
+            monitoring_subjects = TEAMSPEAK_SOURCE_SUBJECTS | MAIN_STREAM_SOURCE_SUBJECTS
+            if subjects & (monitoring_subjects | {"vmix_speaker_background_volume"}):
+                self.obs_monitoring.sync()
+
+            # same order as in activate(), a step is skipped if its subject is active
+            for subject, activate_subject in (
+                    ("addr_config", self.activate_server_langs),
+                    ("stream_settings", self.activate_stream_settings),
+                    ("stream_on", self.activate_stream_on),
+                    ("ts_offset", self.activate_ts_offset),
+                    ("transition_settings", self.activate_transition),
+            ):
+                if subject in subjects or not self.minion_settings.get_subject(subject).is_active():
+                    subject_status = activate_subject()
+                    if not subject_status:
+                        for message in subject_status.message:
+                            status.append_error(message)
+        except BaseException as ex:
+            status.append_error(f"Server::apply_patch(): Couldn't activate settings. Details: {ex}")
+        return status
+
     def _check_initialization(self):
         if self.is_initialized:
             return ExecutionStatus(True)
@@ -440,7 +801,8 @@ class OBSController:
         # establish connections
         try:
             if not self.obs_connected:
-                self.obs_ws = obsws.obsws(host=addr_config.obs_host, port=addr_config.websocket_port, timeout=10)
+                self.obs_ws = OBSClient(host=addr_config.obs_host, port=addr_config.websocket_port,
+                                        password=addr_config.password, timeout=10)
                 self.obs_instance = OBS(self.obs_ws)
                 self.obs_monitoring = OBSMonitoring(obs=self.obs_ws,
                                                     obs_wrapper=self.obs_instance,
@@ -522,6 +884,84 @@ class OBSController:
         """
         return self.obs_monitoring.stop_media()
 
+    def arm_cues(self, cues) -> ExecutionStatus:
+        """
+        Replaces armed timing cues. Media paths are resolved in advance, and every cue fires on the local
+        monotonic clock, so that the playback doesn't depend on the websocket latency.
+        The media of every cue is pre-rolled MEDIA_PREROLL_SECONDS ahead, so that it starts without decoder warm-up,
+        but not before the previous cue has been shown, since a pre-roll replaces the one pending.
+        :param cues: [... {"id": cue id, "name": media name, "at": unix timestamp to play the media at}, ...]
+        :return: ExecutionStatus(), serializable_object - list of ids of armed cues
+        """
+        if not self._check_initialization():
+            return ExecutionStatus(status=False, message="Couldn't initialize the server")
+
+        self.cue_cb_thread.delete_cb_type("cue")
+        self._drop_preroll()
+
+        status = ExecutionStatus(status=True, serializable_object=[])
+        now_time, now = time.time(), time.monotonic()
+        shown_at = float("-inf")  # when the media of the previous cue is shown (after the transition delay)
+        for cue in sorted(cues, key=lambda cue: cue["at"]):
+            path = self.obs_monitoring.find_media(
+                name=cue["name"], media_dir=self.media_dir, search_by_num=True
+            ).serializable_object
+            if not path:  # the media is not downloaded yet, the Skipper will send 'play media' itself
+                status.append_warning(f"Server::arm_cues(): no media found, name {cue['name']}")
+                continue
+            deadline = now + (cue["at"] - now_time)
+            preroll_deadline = max(deadline - MEDIA_PREROLL_SECONDS, shown_at + MEDIA_PREROLL_AFTER_SHOWN_SECONDS)
+            if MEDIA_PREROLL_SECONDS > 0 and preroll_deadline < deadline:
+                self.cue_cb_thread.append_callback_at(
+                    foo=self._preroll_cue, deadline=preroll_deadline, args=(path,), cb_type="cue"
+                )
+            shown_at = deadline + self.obs_instance.transition_point / 1000
+            self.cue_cb_thread.append_callback_at(
+                foo=self._fire_cue, deadline=deadline, args=(path, cue, deadline), cb_type="cue"
+            )
+            status.serializable_object.append(cue["id"])
+        return status
+
+    def disarm_cues(self) -> ExecutionStatus:
+        self.cue_cb_thread.delete_cb_type("cue")
+        self._drop_preroll()
+        return ExecutionStatus(status=True)
+
+    def _preroll_cue(self, path):
+        try:
+            self.obs_instance.preroll_media(path)
+        except Exception as ex:  # the cue is played without the pre-roll then
+            print(f"W PYSERVER::OBSController::_preroll_cue(): {ex}")
+
+    def _drop_preroll(self):
+        try:
+            if self.obs_instance is not None:
+                self.obs_instance.drop_preroll()
+        except Exception as ex:
+            print(f"W PYSERVER::OBSController::_drop_preroll(): {ex}")
+
+    def _fire_cue(self, path, cue, deadline):
+        fired_at, fired_time = time.monotonic(), time.time()
+        status = self.obs_monitoring.run_media_path(path, mode=OBS.PLAYBACK_MODE_CHECK_SAME)
+        if not status:
+            print(f"E PYSERVER::OBSController::_fire_cue(): {status.message}")
+        self._cue_fires.append({
+            "id": cue["id"],
+            "name": cue["name"],
+            "at": cue["at"],
+            "fired_at": fired_time,
+            "jitter_ms": round((fired_at - deadline) * 1000, 3),
+            "result": status.status,
+        })
+
+    def cue_stats(self) -> list:
+        """
+        Returns the last CUE_FIRES_KEPT armed cues fired by this minion, the jitter is measured on the local clock:
+        [... {"id": cue id, "name": media name, "at": unix timestamp the cue was armed for,
+              "fired_at": unix timestamp the cue has fired at, "jitter_ms": ..., "result": True/False}, ...]
+        """
+        return list(self._cue_fires)
+
     def set_media_dir(self, media_dir) -> ExecutionStatus:
         """
         :param media_dir
@@ -533,6 +973,7 @@ class OBSController:
         self.media_dir = media_dir
         if not os.path.isdir(self.media_dir):
             os.system(f"mkdir -p {self.media_dir}")
+        self.media_index.set_media_dir(self.media_dir)
 
         return ExecutionStatus(status=os.path.isdir(self.media_dir))
 
@@ -564,6 +1005,9 @@ class OBSController:
                                                            name_to=OBS.MAIN_STREAM_SOURCE_NAME)
                         finally:
                             self.obs_monitoring.obs_config.inputs.pop(OBS.MAIN_STREAM_SOURCE_NAME_REFRESH_SOURCE)
+                            # the inputs have been replaced behind the monitoring's back
+                            self.obs_monitoring.invalidate(OBS.MAIN_STREAM_SOURCE_NAME)
+                            self.obs_monitoring.invalidate(OBS.MAIN_STREAM_SOURCE_NAME_REFRESH_SOURCE)
                     self.obs_monitoring.sync()
                 except Exception as ex:
                     print(f"ERROR while refreshing the stream: {ex}")
@@ -7,6 +7,7 @@ import json
 import os
 import time
 from obs import OBSController
+from obs.server import PATCH_NEEDS_FULL_CONFIG
 from threading import RLock, Thread
 from googleapiclient.discovery import build
 from util import ExecutionStatus, generate_file_md5
@@ -35,7 +36,7 @@ class Minion:
         def run(self) -> None:
             while True:
                 try:
-                    self.check_files()
+                    self.check_files()  # builds the media index as well
                     time.sleep(60)
                     self.minion.command.send_gdrive_files()
                 except Exception as ex:
@@ -56,6 +57,7 @@ class Minion:
 
         def check_files(self):
             if not self.activate_registry():
+                self.minion.command.obs.media_index.refresh()  # without google drive, the media are probed here
                 return
 
             with self.minion.registry_lock:
@@ -119,6 +121,7 @@ class Minion:
                             self.files[fname] = False  # unmark
 
                 print(f"I PYSERVER::run_drive_sync(): Sync {len(gdrive_files)} files")
+                verified = {}  # fname: md5 of the files verified, so that the media index doesn't hash them again
                 for fileinfo in gfiles["files"]:
                     if "md5Checksum" not in fileinfo:
                         continue
@@ -130,6 +133,7 @@ class Minion:
                         if not self.files[fname] and os.path.isfile(flocal):  # if there is already such file
                             if generate_file_md5(flocal) == fmd5Checksum:  # and hash sums are ok
                                 self.files[fname] = True  # don't download - just mark as downloaded
+                                verified[fname] = fmd5Checksum
                                 # self.on_files_changed()
                             else:  # if we see that the file is different
                                 os.system(f"rm {flocal_}")
@@ -148,12 +152,15 @@ class Minion:
                                 with self.lock:
                                     self.files[fname] = True
                                     # self.on_files_changed()
+                                verified[fname] = fmd5Checksum
+                                self.minion.command.obs.media_index.refresh(known_md5=verified, names=[fname])
                                 print(f"I PYSERVER::run_drive_sync(): Downloaded {fname} => {flocal}")
                             else:
                                 print(f"E PYSERVER::run_drive_sync(): Couldn't verify checksum for {fname}")
                         except Exception as ex:
                             print(f"Couldn't download file {fid} via gdown. Details: {ex}")
                 # self.on_files_changed()
+                self.minion.command.obs.media_index.refresh(known_md5=verified)
 
         def list_files(self) -> Dict[str, bool]:
             with self.lock:
@@ -221,6 +228,13 @@ class Minion:
                 # returns "... minion_settings json ..."
                 with self.minion.registry_lock:
                     return ExecutionStatus(True, serializable_object=self.minion.registry.minion_settings.dict())
+            elif command == "get sync stats":
+                # returns {"calls_avoided": n, "full_resyncs": n, "cached_inputs": [...], ..., "cue_fires": [...]},
+                # see OBSMonitoring.stats() and OBSController.cue_stats()
+                if self.obs.obs_monitoring is None:
+                    return ExecutionStatus(False, "MINION: OBS has not been initialized yet")
+                return ExecutionStatus(True, serializable_object={**self.obs.obs_monitoring.stats(),
+                                                                  "cue_fires": self.obs.cue_stats()})
             elif command == "set config":
                 # input: {"info": "... minion_settings json ..."}
                 if not details or "info" not in details:
@@ -228,6 +242,15 @@ class Minion:
                 with self.minion.registry_lock:
                     self.minion.registry.minion_settings.modify_from(MinionSettings.parse_raw(details["info"]))
                     return self.obs.apply_info(minion_settings=self.minion.registry.minion_settings)
+            elif command == "patch config":
+                # input: {"patch": {... "subject": {... subject settings ...}, ...}} - only the modified subjects
+                if not details or not isinstance(details.get("patch"), dict):
+                    return ExecutionStatus(False, f"MINION: Invalid details for command '{command}':\n '{details}'")
+                with self.minion.registry_lock:
+                    status = self.obs.apply_patch(patch=details["patch"])
+                    if status or PATCH_NEEDS_FULL_CONFIG not in status.message:  # the patch has been applied
+                        self.minion.registry.minion_settings.apply_patch(details["patch"])
+                    return status
             elif command == "dispose":
                 # TODO
                 return ExecutionStatus(False, "MINION: Not implemented")
@@ -240,11 +263,23 @@ class Minion:
                 return self.obs.run_media(name=details["name"], search_by_num=search_by_num, mode=mode)
             elif command == "stop media":
                 return self.obs.stop_media()
+            elif command == "arm timing":
+                # details: {"cues": [... {"id": cue_id, "name": "... 01_video_name.mp4 ...", "at": unix_ts}, ...]}
+                # returns ExecutionStatus(True, serializable_object=[... armed cue_id, ...])
+                if not details or "cues" not in details:
+                    return ExecutionStatus(False, f"MINION: Invalid details for command '{command}':\n '{details}'")
+                return self.obs.arm_cues(details["cues"])
+            elif command == "disarm timing":
+                return self.obs.disarm_cues()
             elif command == "refresh source":
                 return self.obs.refresh_media_source()
             elif command == "list gdrive files":
                 # returns ExecutionStatus(True, serializable_object={"video_1.mp4": True/False, ...})
                 return ExecutionStatus(True, "Ok", serializable_object=self.minion.gdrive_worker.list_files())
+            elif command == "list media":
+                # returns ExecutionStatus(True, serializable_object={"01": {"name": "01_video.mp4", ...}, ...}),
+                # see MediaIndex.list()
+                return ExecutionStatus(True, "Ok", serializable_object=self.obs.media_index.list())
             else:
                 return ExecutionStatus(False, f"MINION: Invalid command {command}")
 
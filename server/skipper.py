@@ -2,10 +2,11 @@
 import json
 import os
 import re
+import time
+from collections import deque
 from datetime import datetime, timedelta
 from threading import RLock, Thread, Lock
 from typing import List, Dict
-from copy import deepcopy
 
 import socketio
 from flask import Flask, request
@@ -17,10 +18,23 @@ from models import (MinionSettings, VmixPlayer, Registry, State, TimingEntry,
                     orjson_dumps, User, SessionContext, passwd_placeholder)
 from models.logging import LogsStorage, Log, LogLevel
 from obs import OBS
-from util import ExecutionStatus, WebsocketResponse, CallbackThread, hash_passwd
+from obs.media import media_num
+from obs.server import PATCH_NEEDS_FULL_CONFIG
+from util import (ExecutionStatus, WebsocketResponse, CallbackThread, TimedLock, Coalescer, hash_passwd,
+                  make_json_patch, json_pointer_unescape)
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 MINION_WS_PORT = 6000
+ACTIVATION_CONCURRENCY = int(os.getenv("ACTIVATION_CONCURRENCY", 16))  # max minions being activated at once
+# min interval between activations of the same settings command for the same langs, 0 - disables coalescing
+COMMAND_COALESCE_WINDOW_MS = float(os.getenv("COMMAND_COALESCE_WINDOW_MS", 50))
+REGISTRY_PATCH_HISTORY = 100  # number of registry patches kept to catch up lagging clients
+# registry changes made within this window after the first one (e.g. by a sheet pull) are broadcast as one patch
+REGISTRY_BROADCAST_DEBOUNCE_MS = float(os.getenv("REGISTRY_BROADCAST_DEBOUNCE_MS", 20))
+TIMING_JITTER_WARN_MS = float(os.getenv("TIMING_JITTER_WARN_MS", 100))  # warn if a timing entry fires later
+# timing entries starting earlier than in TIMING_ARM_MIN_LEAD seconds are not armed on minions (see Timing._arm_cues())
+TIMING_ARM_MIN_LEAD = float(os.getenv("TIMING_ARM_MIN_LEAD", 6))
 
 class BaseObject:
     pass
@@ -29,19 +43,6 @@ class LockableObject(BaseObject):
     def __init__(self):
         self._lock = RLock()
 
-    def __getattr__(self, item):
-        if item == "_lock":
-            return super(BaseObject, self).__getattr__(item)
-        with self._lock:
-            return super(BaseObject, self).__getattr__(item)
-
-    def __setattr__(self, key, value):
-        if key in ("_lock",):
-            super(BaseObject, self).__setattr__(key, value)
-        else:
-            with self._lock:
-                super(BaseObject, self).__setattr__(key, value)
-
 
 class Skipper(LockableObject):
     class Infrastructure(LockableObject):
@@ -75,11 +76,12 @@ class Skipper(LockableObject):
                 self.skipper.registry.server_status = State.running
                 return ExecutionStatus(True, "Infrastructure is locked")
 
+            # set before waiting for the infrastructure lock, which might be held by an activation in progress
+            with self.skipper.registry_lock:
+                self.skipper.registry.server_status = State.initializing
             with self.skipper.infrastructure_lock:
                 try:
-                    with self.skipper.registry_lock:
-                        self.skipper.registry.server_status = State.initializing
-                    self.skipper.event_sender.send_registry_change({"server_status": State.initializing})
+                    self.skipper.bg_worker.broadcast_registry_changes()  # notify clients right away
 
                     langs = self.skipper.registry.list_langs()
                     self.spawner.ensure_langs(langs=langs, wait_for_provision=True)  # [... [lang, ip], ...]
@@ -138,12 +140,15 @@ class Skipper(LockableObject):
             super(Skipper.OBSSheets, self).__init__()
             self.obs_sheets = OBSGoogleSheets()
             self.skipper = skipper
+            # lang: (hash of the sheet row, OBSGoogleSheets.fingerprint() of the registry config it has been applied to)
+            self._pulled: Dict[str, tuple] = {}
             self._lock = Lock()
 
         def setup(self, sheet_url, sheet_name) -> ExecutionStatus:
             with self._lock:
                 try:
                     self.obs_sheets.set_sheet(sheet_url, sheet_name)
+                    self._pulled = {}
                     self.skipper.registry.obs_sheet_url = sheet_url
                     self.skipper.registry.obs_sheet_name = sheet_name
                     return ExecutionStatus(True)
@@ -160,28 +165,62 @@ class Skipper(LockableObject):
                     if langs == "*":
                         langs = None
 
-                    minion_configs: Dict[str, MinionSettings] = self.obs_sheets.pull()
-
-                if self.skipper.registry.infrastructure_lock:  # if infrastructure is locked
-                    registry_langs = list(self.skipper.registry.minion_configs.keys())
-                    for lang in list(minion_configs.keys()):  # drop new langs
-                        if lang not in registry_langs:
-                            minion_configs.pop(lang)
-
-                if langs is not None:  # if need to pull only specified langs
-                    minion_configs = {lang: minion_configs[lang] for lang in minion_configs if lang in langs}
-                else:
-                    for lang in self.skipper.registry.list_langs():  # list langs in registry
-                        if lang not in minion_configs:  # if lang has been deleted in google sheets
-                            self.skipper.registry.delete_minion(lang)
+                    # Rows which haven't changed since the last pull are neither parsed nor applied, so that
+                    # their minions are not re-activated. A row is pulled again if its lang has been deleted
+                    # from the registry or its config has been changed by a command meanwhile
+                    with self.skipper.registry_lock:
+                        registry_configs = self.skipper.registry.minion_configs
+                        row_hashes = {
+                            lang: row_hash
+                            for lang, (row_hash, fingerprint) in self._pulled.items()
+                            if lang in registry_configs
+                            and OBSGoogleSheets.fingerprint(registry_configs[lang]) == fingerprint
+                        }
+
+                    # network I/O, should not be done under the registry lock
+                    minion_configs, row_hashes = self.obs_sheets.pull_changed(row_hashes)
+                    sheet_langs = list(row_hashes.keys())
 
-                for lang in minion_configs:
-                    self.skipper.registry.update_minion(lang, minion_configs[lang])
+                    with self.skipper.registry_lock:
+                        self._apply(minion_configs, sheet_langs, langs)
+                        # remember the rows which are in the registry now, skipped langs keep their previous hashes
+                        self._pulled = {
+                            lang: (
+                                (row_hashes[lang], OBSGoogleSheets.fingerprint(config))
+                                if langs is None or lang in langs
+                                else self._pulled.get(lang)
+                            )
+                            for lang, config in self.skipper.registry.minion_configs.items()
+                            if lang in row_hashes and (langs is None or lang in langs or lang in self._pulled)
+                        }
                 return ExecutionStatus(True)
             except Exception as ex:
                 return ExecutionStatus(False, f"Couldn't pull OBS sheets. Details: {ex}, "
                                               f"{traceback.format_exc()}")
 
+        def _apply(self, minion_configs: Dict[str, MinionSettings], sheet_langs: List[str], langs: List[str] = None):
+            """
+            Applies changed configs to the registry. Should be called under the registry lock
+            :param minion_configs: {... lang: settings, ...} of the changed rows
+            :param sheet_langs: all the langs of the sheet
+            :param langs: if specified, only these langs are applied
+            """
+            if self.skipper.registry.infrastructure_lock:  # if infrastructure is locked
+                registry_langs = list(self.skipper.registry.minion_configs.keys())
+                for lang in list(minion_configs.keys()):  # drop new langs
+                    if lang not in registry_langs:
+                        minion_configs.pop(lang)
+
+            if langs is not None:  # if need to pull only specified langs
+                minion_configs = {lang: minion_configs[lang] for lang in minion_configs if lang in langs}
+            else:
+                for lang in self.skipper.registry.list_langs():  # list langs in registry
+                    if lang not in sheet_langs:  # if lang has been deleted in google sheets
+                        self.skipper.registry.delete_minion(lang)
+
+            for lang in minion_configs:
+                self.skipper.registry.update_minion(lang, minion_configs[lang])
+
         def push(self) -> ExecutionStatus:
             # with self.skipper.registry_lock:
             try:
@@ -200,9 +239,11 @@ class Skipper(LockableObject):
             master_user = User.master()
             self.users: dict[str, User] = {master_user.login: master_user}
             self.authorized_users: dict[str, User] = {}
+            self.user_rooms: dict[str, str] = {}  # sid: socket.io room the client is joined to
             self.skipper = skipper
             self.public_commands = Skipper.SecurityWorker.get_public_commands()
             self._security_lock = Lock()
+            self._sync_message = "Success"  # sync status of the last sync which has applied the sheet
 
         @staticmethod
         def get_public_commands() -> set[str]:
@@ -229,6 +270,7 @@ class Skipper(LockableObject):
             with self._security_lock:
                 if login in self.users and self.users[login].passwd_hash == hash_passwd(passwd):
                     self.authorized_users.update({sid: self.users[login]})
+                    self._join_room(sid, self.users[login])
                     return True
                 return False
 
@@ -237,77 +279,135 @@ class Skipper(LockableObject):
             with self._security_lock:
                 if sid in self.authorized_users:
                     self.authorized_users.pop(sid)
+                self._leave_room(sid)
 
-        def _sync_from_sheets(self):
+        @staticmethod
+        def get_room(user: User) -> str:
+            """
+            Returns a socket.io room name for the user: `admins` for admins,
+            `lang:<code>` (or `lang:<code>+<code>` for several langs) for others.
+            Users in the same room see exactly the same part of the registry
+            """
+            if user.is_admin():
+                return "admins"
+            return f"lang:{user.permissions_key()}"
+
+        def get_room_members(self) -> Dict[str, List[str]]:  # pulic interface
+            """Returns room: [... sid, ...] for all authorized users"""
+            with self._security_lock:
+                members = {}
+                for sid, room in self.user_rooms.items():
+                    members.setdefault(room, []).append(sid)
+                return members
+
+        def _join_room(self, sid: str, user: User):
+            room = self.get_room(user)
+            prev_room = self.user_rooms.get(sid)
+            if prev_room == room:
+                return
+            if prev_room:
+                self.skipper.sio.leave_room(sid, prev_room)
+            self.skipper.sio.enter_room(sid, room)
+            self.user_rooms[sid] = room
+
+        def _leave_room(self, sid: str):
+            room = self.user_rooms.pop(sid, None)
+            if room:
+                self.skipper.sio.leave_room(sid, room)
+
+        def _refresh_rooms(self):
+            # permissions of authorized users might be changed by the sheet sync
+            for sid, user in self.authorized_users.items():
+                self._join_room(sid, user)
+
+        def _sync_users(self, sheet_data: list, errors: list):
+            """
+            Builds a new users dict from the sheet data and swaps it in. Users which are already known keep
+            their objects (authorized sessions refer to them). Changes of the sheet are buffered, see
+            UsersGoogleSheets.flush()
+            """
+            users = {}
+            master_user = User.master()
+            users[master_user.login] = master_user
+            for row_data in sheet_data:
+                col_index = row_data["col"]
+                login = row_data["login"]
+                passwd = row_data["passwd"]
+                passwd_hash = row_data["hash"]
+                permissions = row_data["permissions"]
+                if login.strip() == "":
+                    continue
+                # Get cached user by login equality
+                if not self._validate_user(errors, login, permissions, users):
+                    continue
+                cur_user = self._sync_cur_user(login, passwd_hash, permissions, self.users, users)
+
+                # Disallow to change manually hash if password is a placeholder
+                if passwd == passwd_placeholder:
+                    if cur_user and passwd_hash != cur_user.passwd_hash:
+                        self.users_sheet.set_passwd(col_index, passwd_placeholder, cur_user.passwd_hash)
+                # If password is empty - reset hash
+                elif passwd.strip() == "":
+                    errors.append(f"{login}: has no password")
+                    if passwd_hash.strip() != "":
+                        self.users_sheet.reset_passwd_hash(col_index)
+                # Update password and hash
+                else:
+                    passwd_hash = hash_passwd(passwd)
+                    if passwd != passwd_placeholder or passwd_hash != cur_user.passwd_hash:
+                        cur_user.passwd_hash = passwd_hash
+                        self.users_sheet.set_passwd(col_index, passwd_placeholder, passwd_hash)
+            self.users = users  # swap atomically, readers never see a partially built dict
+
+        def sync_from_sheets(self):  # pulic interface
+            """
+            Syncs users with Google Sheet. The sheet is fetched and written back outside of any lock,
+            only the users swap is done under the security lock. If the sheet has not been changed, users are not
+            synced, but the sync status is still written with the time of the check, as a heartbeat
+            """
             if not self.users_sheet.setup_status:
                 return
             errors = []
+            message = None
             try:
-                sheet_data = self.users_sheet.fetch_all()
-                prev_users = self.users
-                # Reset users list
-                master_user = User.master()
-                self.users = {master_user.login: master_user}
-                for i in range(len(sheet_data)):
-                    row_data = sheet_data[i]
-                    col_index = row_data["col"]
-                    login = row_data["login"]
-                    passwd = row_data["passwd"]
-                    passwd_hash = row_data["hash"]
-                    permissions = row_data["permissions"]
-                    if login.strip() == "":
-                        continue
-                    # Get cached user by login equality
-                    if not self._validate_user(errors, login, permissions):
-                        continue
-                    cur_user = self._sync_cur_user(login, passwd_hash, permissions, prev_users)
-
-                    # Disallow to change manually hash if password is a placeholder
-                    if passwd == passwd_placeholder:
-                        if cur_user and passwd_hash != cur_user.passwd_hash:
-                            self.users_sheet.set_passwd(col_index, passwd_placeholder, cur_user.passwd_hash)
-                    # If password is empty - reset hash
-                    elif passwd.strip() == "":
-                        errors.append(f"{login}: has no password")
-                        if passwd_hash.strip() != "":
-                            self.users_sheet.reset_passwd_hash(col_index)
-                    # Update password and hash
-                    else:
-                        passwd_hash = hash_passwd(passwd)
-                        if passwd != passwd_placeholder or passwd_hash != cur_user.passwd_hash:
-                            cur_user.passwd_hash = passwd_hash
-                            self.users_sheet.set_passwd(col_index, passwd_placeholder, passwd_hash)
+                sheet_data = self.users_sheet.fetch_if_changed()
+                if sheet_data is None:  # nothing to sync, the message of the last sync is kept
+                    message = self._sync_message
+                else:
+                    with self._security_lock:
+                        self._sync_users(sheet_data, errors)
+                        self._refresh_rooms()
             except Exception as e:
                 errors.append(str(e))
+                self.users_sheet.invalidate()  # retry with the same data next time
 
-            if len(errors) == 0:
-                message = "Success"
-            else:
-                message = "\n".join(errors)
+            if message is None:
+                if len(errors) == 0:
+                    message = "Success"
+                else:
+                    message = "\n".join(errors)
+                self._sync_message = message
             self.users_sheet.set_sync_status(message)
+            self.users_sheet.flush()  # single request for all the changes
 
-        def sync_from_sheets(self):  # pulic interface
-            """Syncs users with Google Sheet"""
-            with self._security_lock:
-                self._sync_from_sheets()
-
-        def _validate_user(self, errors, login, permissions):
+        def _validate_user(self, errors, login, permissions, users):
             if not re.match(r"^(?=.{2,50}$)(?:[a-zA-Z\d]+(?:(?:-|_)[a-zA-Z\d])*)+$", login):
                 errors.append(f"{login}: invalid login (allowed only alphanumeric and _ or -)")
                 return False
             if not permissions or len(permissions) < 1:
                 errors.append(f"{login}: has no permissions")
                 return False
-            if login in self.users:
+            if login in users:
                 errors.append(f"{login}: duplicated login")
                 return False
             return True
 
-        def _sync_cur_user(self, login, passwd_hash, permissions, prev_users):
+        def _sync_cur_user(self, login, passwd_hash, permissions, prev_users, users):
             if login in prev_users:
                 cur_user = prev_users[login]
-                cur_user.permissions = permissions
-                self.users.update({cur_user.login: cur_user})
+                if cur_user.permissions != permissions:
+                    cur_user.permissions = permissions
+                users.update({cur_user.login: cur_user})
                 return cur_user
             elif login.strip() != "":
                 cur_user = User(
@@ -316,21 +416,20 @@ class Skipper(LockableObject):
                     passwd_hash=passwd_hash,
                     permissions=permissions,
                 )
-                self.users.update({cur_user.login: cur_user})
+                users.update({cur_user.login: cur_user})
                 return cur_user
             return None
 
         def set_sheets(self, sheet_url: str, sheet_name: str) -> ExecutionStatus:  # pulic interface
             """Binds users with Google Sheet table"""
             try:
+                with self._security_lock:
+                    self.users_sheet.set_sheet(sheet_url, sheet_name)
                 with self.skipper.registry_lock:
-                    with self._security_lock:
-                        self.users_sheet.set_sheet(sheet_url, sheet_name)
                     self.skipper.registry.users_sheet_url = sheet_url
                     self.skipper.registry.users_sheet_name = sheet_name
 
-                with self._security_lock:
-                    self._sync_from_sheets()
+                self.sync_from_sheets()
                 return ExecutionStatus(True)
             except Exception as ex:
                 return ExecutionStatus(False, f"Couldn't set up users sheet config.\nDetails: "
@@ -353,14 +452,20 @@ class Skipper(LockableObject):
 
         def copy_registry_for_user(self, user: User, masked=True) -> dict:  # pulic interface
             """Returns a copy of the original registry without data user has no access"""
-            with self.skipper.registry_lock:
-                registry = self.skipper.registry.masked_dict() if masked else self.skipper.registry.dict()
-                return self.adjust_registry_for_user(registry, user)
+            if masked:
+                registry = self.skipper.registry.snapshot()  # no need to lock, snapshot is copy-on-write
+            else:
+                with self.skipper.registry_lock:
+                    registry = self.skipper.registry.dict()
+            return self.adjust_registry_for_user(registry, user)
 
         @staticmethod
         def adjust_registry_for_user(registry: dict, user: User) -> dict:  # pulic interface
-            """Returns a copy of the original registry without data user has no access"""
-            registry = deepcopy(registry)
+            """
+            Returns a copy of the original registry without data user has no access. Note that the copy is shallow:
+            nested values are shared with the original registry and must not be modified
+            """
+            registry = dict(registry)
             if user.is_admin():
                 return registry
             perms = user.permissions
@@ -375,6 +480,27 @@ class Skipper(LockableObject):
                 registry.pop("active_vmix_player")
             return registry
 
+        @staticmethod
+        def adjust_patch_for_user(patch: list, user: User) -> list:  # pulic interface
+            """Returns registry patch operations without data user has no access"""
+            if user.is_admin():
+                return patch
+            perms = user.permissions
+            adjusted = []
+            for op in patch:
+                tokens = [json_pointer_unescape(token) for token in op["path"].split("/")[1:]]
+                root_key = tokens[0]
+                if root_key in ("vmix_players", "active_vmix_player"):
+                    continue
+                if root_key in ("minion_configs", "gdrive_files"):
+                    if len(tokens) > 1 and tokens[1] not in perms:  # lang the user has no access to
+                        continue
+                    if len(tokens) == 1 and "value" in op:  # the whole root key has been replaced
+                        value = Skipper.SecurityWorker.adjust_registry_for_user({root_key: op["value"]}, user)
+                        op = {**op, "value": value[root_key]}
+                adjusted.append(op)
+            return adjusted
+
     class Minion(LockableObject):
         def __init__(self, minion_ip, lang, skipper, ws_port=MINION_WS_PORT):
             super(Skipper.Minion, self).__init__()
@@ -411,6 +537,7 @@ class Skipper(LockableObject):
         def _on_gdrive_files_changed(self, data):
             with self.skipper.registry_lock:
                 self.skipper.registry.gdrive_files[self.lang] = json.loads(data)
+                self.skipper.registry.mark_changed("gdrive_files")
 
         def close(self):
             self.sio.disconnect()
@@ -418,6 +545,10 @@ class Skipper(LockableObject):
         def apply_config(self, minion_config: MinionSettings) -> WebsocketResponse:
             return self.command(command="set config", details={"info": minion_config.json()})
 
+        def patch_config(self, patch: dict) -> WebsocketResponse:
+            """:param patch: output of MinionSettings.patch()"""
+            return self.command(command="patch config", details={"patch": patch})
+
         def command(self, command, details=None) -> WebsocketResponse:
             response = WebsocketResponse()
 
@@ -443,6 +574,11 @@ class Skipper(LockableObject):
             self.skipper = skipper
             self.cb_thread = CallbackThread()
             self.cb_thread.start()
+            # The timing runs on time.monotonic(), so that system time adjustments don't shift the entries.
+            # registry.timing_start_time is converted to monotonic time once, when the timing is started
+            self._start_monotonic: float = None
+            self._start_anchor: datetime = None  # registry.timing_start_time `_start_monotonic` was computed for
+            self._armed: Dict[str, set] = {}  # lang: {... id of the timing entry armed on the minion, ...}
 
         def setup(self, sheet_url, sheet_name) -> ExecutionStatus:
             """
@@ -466,18 +602,26 @@ class Skipper(LockableObject):
             :return: ExecutionStatus
             """
 
-            def foo_maker(skipper: Skipper, id: int):
+            def foo_maker(skipper: Skipper, id: int, deadline: float):
                 def foo() -> ExecutionStatus:
+                    fired_at = time.monotonic()
                     entry: TimingEntry = skipper.registry.timing_list[id]
                     if not entry.is_enabled or entry.is_played:  # if disabled or already has been played
                         return ExecutionStatus(True)
-
-                    status: ExecutionStatus = skipper.command.exec(
-                        command="play media",
-                        details={"name": entry.name, "search_by_num": True, "mode": OBS.PLAYBACK_MODE_CHECK_SAME},
-                    )
+                    self._track_jitter(entry, deadline, fired_at)
+
+                    details = {"name": entry.name, "search_by_num": True, "mode": OBS.PLAYBACK_MODE_CHECK_SAME}
+                    # minions which have the entry armed play it by their own clocks
+                    langs = [lang for lang in skipper.minions if id not in self._armed.get(lang, ())]
+                    if langs:
+                        status: ExecutionStatus = skipper.command.exec(command="play media", details=details,
+                                                                       lang=langs)
+                    else:
+                        status = ExecutionStatus(True, "Played by minions' armed timing")
+                        skipper.event_handler.on_command_completed("play media", details, "*", status, None)
 
                     entry.is_played = True
+                    skipper.registry.mark_changed("timing_list")
                     return status
 
                 return foo
@@ -485,21 +629,78 @@ class Skipper(LockableObject):
             try:
                 self.cb_thread.delete_cb_type("timing")
 
-                time_from_start = self.get_current_timedelta()
+                start_monotonic = self._get_start_monotonic()
+                if start_monotonic is None:  # the timing is not running
+                    return ExecutionStatus()
+                start_time = self.skipper.registry.timing_start_time
                 for i, entry in enumerate(self.skipper.registry.timing_list):
-                    self.cb_thread.append_callback(
-                        foo=foo_maker(self.skipper, i),
-                        delay=(entry.timestamp - time_from_start).total_seconds(),
+                    deadline = start_monotonic + entry.timestamp.total_seconds()
+                    entry.scheduled_time = start_time + entry.timestamp
+                    self.cb_thread.append_callback_at(
+                        foo=foo_maker(self.skipper, i, deadline),
+                        deadline=deadline,
                         cb_type="timing",
                     )
+                self.skipper.registry.mark_changed("timing_list")
+                self._arm_cues(start_monotonic)
                 return ExecutionStatus()
             except Exception as ex:
                 return ExecutionStatus(False, f"Something happened while synchronizing the timing. Details: {ex}")
 
+        def _arm_cues(self, start_monotonic: float):
+            """
+            Sends upcoming timing entries to minions ahead of time, so that every minion plays them by its own clock
+            rather than waiting for the 'play media' command. Entries which are not armed on some minion
+            (e.g. the media is not downloaded yet) are played by the Skipper
+            """
+            now_time, now = time.time(), time.monotonic()
+            cues = []
+            for i, entry in enumerate(self.skipper.registry.timing_list):
+                time_left = start_monotonic + entry.timestamp.total_seconds() - now
+                if entry.is_enabled and not entry.is_played and time_left >= TIMING_ARM_MIN_LEAD:
+                    # minions have their own monotonic clocks, so the time is passed as a unix timestamp
+                    cues.append({"id": i, "name": entry.name, "at": now_time + time_left})
+            # the previous map is kept until minions respond, so that an entry due meanwhile is not played
+            # by the Skipper as well as by minions which have it armed
+            armed = {}
+            status = self.skipper.command.minion_command("arm timing", details={"cues": cues})
+            for lang, lang_status in (status.serializable_object or {}).items():
+                if lang_status["result"] and lang_status["serializable_object"]:
+                    armed[lang] = set(lang_status["serializable_object"])
+            self._armed = armed
+
+        def _disarm_cues(self):
+            self._armed = {}
+            self.skipper.command.minion_command("disarm timing")
+
         def get_current_timedelta(self) -> timedelta:
-            if self.skipper.registry.timing_start_time is None:
+            start_monotonic = self._get_start_monotonic()
+            if start_monotonic is None:
                 return timedelta(days=-999)
-            return datetime.now() - self.skipper.registry.timing_start_time
+            return timedelta(seconds=time.monotonic() - start_monotonic)
+
+        def _get_start_monotonic(self):
+            """Converts registry.timing_start_time to time.monotonic() once per timing start"""
+            start_time = self.skipper.registry.timing_start_time
+            if start_time is None:
+                self._start_monotonic, self._start_anchor = None, None
+            elif start_time != self._start_anchor:  # the timing has been (re)started or loaded from disk
+                self._start_monotonic = time.monotonic() + (start_time - datetime.now()).total_seconds()
+                self._start_anchor = start_time
+            return self._start_monotonic
+
+        def _track_jitter(self, entry: TimingEntry, deadline: float, fired_at: float):
+            if self._start_monotonic is None:  # the timing has been stopped meanwhile
+                return
+            entry.fired_time = self.skipper.registry.timing_start_time + \
+                timedelta(seconds=fired_at - self._start_monotonic)
+            entry.jitter_ms = round((fired_at - deadline) * 1000, 3)
+            if entry.jitter_ms > TIMING_JITTER_WARN_MS:
+                self.skipper.logger.log_timing_jitter(
+                    message=f"Timing entry '{entry.name}' fired {entry.jitter_ms} ms late",
+                    extra={"name": entry.name, "scheduled_time": entry.scheduled_time.isoformat(),
+                           "fired_time": entry.fired_time.isoformat(), "jitter_ms": entry.jitter_ms},
+                )
 
         def pull(self) -> ExecutionStatus:
             """
@@ -512,7 +713,7 @@ class Skipper(LockableObject):
                 if not self.sheets.setup_status:
                     return ExecutionStatus(False, f"setup_status of timing_sheets is False")
 
-                timing_df = self.sheets.pull()
+                timing = self.sheets.pull()  # [... (timestamp, name), ...]
 
                 # if timing_delta < 0 -> timing has not been started yet
                 timing_delta = self.get_current_timedelta()  # now() - timing_start_time
@@ -520,12 +721,51 @@ class Skipper(LockableObject):
                     TimingEntry(
                         name=name, timestamp=timestamp, is_enabled=True, is_played=timing_delta > timestamp
                     )
-                    for timestamp, name in timing_df.values
+                    for timestamp, name in timing
                 ]
                 return self._sync_callbacks()
             except Exception as ex:
                 return ExecutionStatus(False, str(ex))
 
+        def validate(self, langs=None) -> ExecutionStatus:
+            """
+            Checks the timing pulled against the media indexes of the minions (see minion's 'list media'),
+            so that missing media are found before the timing is run.
+            Returns ExecutionStatus, where serializable object has the following structure:
+            {
+                lang: ExecutionStatus(serializable_object={"missing": [... name ...],
+                                                           "too_long": [... name ...]}).dict(),
+                ...
+            }
+            `too_long` - media which last longer than the gap to the next timing entry
+            """
+            entries = sorted(
+                [entry for entry in self.skipper.registry.timing_list if entry.is_enabled],
+                key=lambda entry: entry.timestamp,
+            )
+            status = self.skipper.command.minion_command("list media", langs=langs)
+            result = ExecutionStatus(True, serializable_object={})
+            for lang, lang_status in (status.serializable_object or {}).items():
+                if not lang_status["result"]:
+                    result.status = False
+                    result.serializable_object[lang] = lang_status
+                    continue
+                media = lang_status["serializable_object"] or {}
+                lang_result = ExecutionStatus(True, serializable_object={"missing": [], "too_long": []})
+                for i, entry in enumerate(entries):
+                    media_file = media.get(media_num(entry.name))
+                    if media_file is None:
+                        lang_result.append_error(f"No media found, name {entry.name}")
+                        lang_result.serializable_object["missing"].append(entry.name)
+                    elif i + 1 < len(entries) and media_file["duration"] is not None and \
+                            media_file["duration"] > (entries[i + 1].timestamp - entry.timestamp).total_seconds():
+                        lang_result.append_warning(f"Media {media_file['name']} lasts longer than the gap "
+                                                   f"to the next timing entry {entries[i + 1].name}")
+                        lang_result.serializable_object["too_long"].append(entry.name)
+                result.status = result.status and bool(lang_result)
+                result.serializable_object[lang] = lang_result.dict()
+            return result
+
         def run(self, countdown: timedelta = None, daytime: datetime = None) -> ExecutionStatus:
             """
             Runs the timing. Note that the timing should be pulled before calling `run()`.
@@ -537,6 +777,7 @@ class Skipper(LockableObject):
             try:
                 if not self.sheets.setup_status:
                     return ExecutionStatus(False, f"setup_status of timing_sheets is False")
+                self._start_anchor = None  # re-anchor the monotonic clock even if the start time is the same
                 if countdown is not None:
                     self.skipper.registry.timing_start_time = datetime.now() + countdown
                 elif daytime is not None:
@@ -554,7 +795,10 @@ class Skipper(LockableObject):
                 self.skipper.registry.timing_start_time = None
                 for entry in self.skipper.registry.timing_list:
                     entry.is_played = False
+                    entry.scheduled_time, entry.fired_time, entry.jitter_ms = None, None, None
+                self.skipper.registry.mark_changed("timing_list")
                 self.cb_thread.delete_cb_type("timing")
+                self._disarm_cues()
                 return ExecutionStatus(True)
             except Exception as ex:
                 return ExecutionStatus(False, f"Something happened while stopping the timing. Details: {ex}")
@@ -610,23 +854,56 @@ class Skipper(LockableObject):
         def __init__(self, skipper):
             super(Skipper.EventSender, self).__init__()
             self.skipper: Skipper = skipper
+            self.client_versions: Dict[str, int] = {}  # sid: last registry version delivered to the client
+
+        def send_registry_change(self, version: int):
+            """
+            Sends a registry patch to every client who has enough access rights. The patch is computed against
+            the last version delivered to the client, clients which are too far behind get a full resync.
+            Clients are grouped by room (see `SecurityWorker.get_room()`) and base version, so that the payload
+            is filtered and serialized once per group. If the whole room is on the same base version -
+            the event is emitted once to the room rather than to every client
+            """
+            for room, room_sids in self.skipper.security.get_room_members().items():
+                user = self.skipper.security.get_user(room_sids[0])
+                if user is None:
+                    continue
+                groups: Dict[int, List[str]] = {}  # base version: [... sid, ...]
+                for sid in room_sids:
+                    groups.setdefault(self.client_versions.get(sid), []).append(sid)
+                for base_version, sids in groups.items():
+                    to_room = room if len(groups) == 1 else None
+                    patch = None if base_version is None else self.skipper.bg_worker.get_registry_patch(base_version)
+                    if patch is None:  # clients' version is unknown or is out of history
+                        self.send_registry_resync(sids, user, room=to_room)
+                        continue
+                    patch = self.skipper.security.adjust_patch_for_user(patch, user)
+                    if not patch:  # nothing is visible for the group - keep the base version, it'll be caught up later
+                        continue
+                    data = orjson_dumps({"version": version, "base_version": base_version, "patch": patch})
+                    self._send_to_group("on_registry_change", data, sids, room=to_room)
+                    for sid in sids:
+                        self.client_versions[sid] = version
+
+        def send_registry_resync(self, sids: List[str], user: User = None, room: str = None):
+            """
+            Sends the whole registry (as of the last broadcast version) to the clients with equal permissions.
+            If `room` is specified, the event is emitted once to the room, which should consist of `sids` only
+            """
+            user = user or self.skipper.security.get_user(sids[0])
+            if user is None:
+                return
+            version, registry = self.skipper.bg_worker.get_registry_state(sids=sids)
+            registry = self.skipper.security.adjust_registry_for_user(registry, user)
+            data = orjson_dumps({"version": version, "registry": registry})
+            self._send_to_group("on_registry_change", data, sids, room=room)
 
-        def send_registry_change(self, registry: dict):
-            """Sends a registry changes to every client who has enough access rights"""
-            for sid, user in self.skipper.security.authorized_users.items():
-                registry = self.skipper.security.adjust_registry_for_user(registry, user)
-                if len(registry.keys()) > 0:
-                    self._send_event("on_registry_change", {"registry": registry}, sid=sid)
+        def forget_client(self, sid: str):
+            self.client_versions.pop(sid, None)
 
         def send_log(self, log: Log):
             """Sends log events to all admins"""
-            for sid, user in self.skipper.security.authorized_users.items():
-                if user.is_admin():
-                    self._send_event("on_log", {"log": log.dict()}, sid=sid)
-                # else:
-                #     if log.extra and "command" in log.extra \
-                #             and log.extra["command"] in Skipper.SecurityWorker.get_public_commands():
-                #         self._send_event("on_log", {"log": log.dict()}, sid=sid)
+            self._send_event("on_log", {"log": log.dict()}, to="admins")
 
         def send_auth_result(self, sid: str, status: bool):
             """Sends an auth result to user himself"""
@@ -634,14 +911,40 @@ class Skipper(LockableObject):
                 data = {"status": True, "message": "User successfully authorized"}
             else:
                 data = {"status": False, "message": "Login or password is not valid"}
-            self._send_event("on_auth", data, sid)
+            self._send_event("on_auth", data, to=sid)
+
+        def send_command_progress(self, sid: str, progress_id: str, command: str, lang: str, status: dict):
+            """Sends a per-lang result of a streamed command to the client who has issued the command"""
+            self._send_event("on_command_progress", {
+                "id": progress_id,
+                "command": command,
+                "lang": lang,
+                "status": status,
+            }, to=sid)
+
+        def send_datetime_update(self):
+            """Sends current server time to all authorized clients, once per room (see `SecurityWorker.get_room()`)"""
+            data = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+            for room in self.skipper.security.get_room_members():
+                self._send_event("on_datetime_update", data, to=room)
+
+        def _send_to_group(self, event: str, data, sids: List[str], room: str = None):
+            if room:
+                self._send_event(event, data, to=room)
+            else:
+                for sid in sids:
+                    self._send_event(event, data, to=sid)
 
-        def _send_event(self, event: str, data: dict, sid: str = None):
-            """Sends an event to specific client by SessionID (SID) or broadcasts an event it SID didn't specify"""
+        def _send_event(self, event: str, data, to: str = None):
+            """
+            Sends an event to specific client by SessionID (SID) or to a room, or broadcasts an event
+            if `to` didn't specify. `data` is either a dict or an already serialized json string
+            """
             try:
-                data = orjson_dumps(data)
-                if sid:
-                    self.skipper.sio.emit(event, data, to=sid)
+                if not isinstance(data, str):
+                    data = orjson_dumps(data)
+                if to:
+                    self.skipper.sio.emit(event, data, to=to)
                 else:
                     self.skipper.sio.emit(event, data, broadcast=True)
             except Exception as ex:
@@ -695,6 +998,14 @@ class Skipper(LockableObject):
                 extra=extra,
             ))
 
+        def log_timing_jitter(self, message: str, extra: dict):
+            self._add_log(Log(
+                level=LogLevel.warn,
+                type="timing_jitter",
+                message=message,
+                extra=extra,
+            ))
+
         def log_minion_setup_error(self, message: str, error: Exception):
             self._add_log(Log(
                 level=LogLevel.error,
@@ -742,6 +1053,7 @@ class Skipper(LockableObject):
             super(Skipper.Command, self).__init__()
             self.skipper: Skipper = skipper
             self.pull_sheet_lock = Lock()
+            self.coalescer = Coalescer(window=COMMAND_COALESCE_WINDOW_MS / 1000)
 
         @classmethod
         def valid(cls, command: str):
@@ -873,6 +1185,12 @@ class Skipper(LockableObject):
                 raise ValueError(f"SKIPPER: Validation error. Invalid command '{command_raw}'")
 
             command = json.loads(command_raw)
+            if command.get("stream") and not command.get("id"):
+                raise ValueError(f"SKIPPER: Validation error. A streamed command requires an 'id' '{command_raw}'")
+            if command.get("stream") and session:
+                # per-command copy of the session, which carries the correlation id of the command
+                session = SessionContext(sid=session.sid, ip=session.ip, user=session.user,
+                                         progress_id=command["id"])
             if "details" not in command:
                 command["details"] = {}
             if "lang" not in command:
@@ -965,8 +1283,12 @@ class Skipper(LockableObject):
                     else:
                         return ExecutionStatus(False, "Invalid details provided for command 'get info'")
 
-                    registry = self.skipper.security.copy_registry_for_user(session.user, masked=masked)
-                    return ExecutionStatus(True, serializable_object=orjson_dumps({"registry": registry}))
+                    version, registry = self.skipper.bg_worker.get_registry_state(
+                        sids=[session.sid] if session.sid else None, masked=masked, flush=True
+                    )
+                    registry = self.skipper.security.adjust_registry_for_user(registry, session.user)
+                    return ExecutionStatus(True, serializable_object=orjson_dumps({"registry": registry,
+                                                                                   "version": version}))
                 elif command in (
                         "set stream settings",
                         "set teamspeak offset",
@@ -988,6 +1310,12 @@ class Skipper(LockableObject):
                     return ExecutionStatus(True, serializable_object={
                         "logs": self.skipper.logger.logs.get(count)
                     })
+                elif command == "get lock stats":
+                    locks = (self.skipper.registry_lock, self.skipper.infrastructure_lock)
+                    return ExecutionStatus(True, serializable_object={
+                        **{lock.name: lock.stats() for lock in locks},
+                        "command_coalescer": self.coalescer.stats(),
+                    })
                 elif command == "infrastructure lock":
                     # with self.registry_lock:
                     self.skipper.registry.infrastructure_lock = True
@@ -1018,6 +1346,7 @@ class Skipper(LockableObject):
                         name=name,
                         active=False
                     )
+                    self.skipper.registry.mark_changed("vmix_players")
                     return ExecutionStatus(True)
                 elif command == "vmix players remove":
                     # details: {"ip": "ip address" | "name": "ip name"}
@@ -1037,6 +1366,7 @@ class Skipper(LockableObject):
 
                     # with self.registry_lock:
                     self.skipper.registry.vmix_players.pop(ip)
+                    self.skipper.registry.mark_changed("vmix_players")
                     return ExecutionStatus(True)
                 # elif command == "vmix players list":
                 #     # no details needed
@@ -1058,6 +1388,7 @@ class Skipper(LockableObject):
                     self.skipper.registry.active_vmix_player = ip
                     for ip_ in self.skipper.registry.vmix_players:
                         self.skipper.registry.vmix_players[ip_].active = (ip == ip_)
+                    self.skipper.registry.mark_changed("vmix_players")
                     return ExecutionStatus(True)
                 elif command == "start streaming":
                     for minion_config in minion_configs:
@@ -1119,6 +1450,8 @@ class Skipper(LockableObject):
                         except Exception as ex:
                             return ExecutionStatus(False, f"Invalid 'daytime'. Details: {ex}")
                     return self.skipper.timing.run(countdown=countdown, daytime=daytime)
+                elif command == "validate timing":
+                    return self.skipper.timing.validate(langs=langs)
                 elif command == "stop timing":
                     return self.skipper.timing.stop()
                 elif command == "remove timing":
@@ -1161,7 +1494,7 @@ class Skipper(LockableObject):
                 for settings in minion_settings:
                     settings.stream_settings.server = details["server"]
                     settings.stream_settings.key = details["key"]
-                return self.skipper.activate_registry()
+                return self._activate_coalesced(command, langs)
             elif command == "set teamspeak offset":
                 # details: {"value": numeric_value}  - offset in milliseconds
                 if "value" not in details:
@@ -1172,7 +1505,7 @@ class Skipper(LockableObject):
                     return ExecutionStatus(False, f"Couldn't parse teamspeak offset: {details}")
                 for settings in minion_settings:
                     settings.ts_offset.value = value
-                return self.skipper.activate_registry()
+                return self._activate_coalesced(command, langs)
             elif command == "set teamspeak volume":
                 # details: {"value": numeric_value}  - volume in decibels
                 if "value" not in details:
@@ -1183,7 +1516,7 @@ class Skipper(LockableObject):
                     return ExecutionStatus(False, f"Couldn't parse teamspeak volume: {details}")
                 for settings in minion_settings:
                     settings.ts_volume.value = value
-                return self.skipper.activate_registry()
+                return self._activate_coalesced(command, langs)
             elif command == "set source volume":
                 # details: {"value": numeric_value}  - volume in decibels
                 if "value" not in details:
@@ -1194,7 +1527,7 @@ class Skipper(LockableObject):
                     return ExecutionStatus(False, f"Couldn't parse source volume: {details}")
                 for settings in minion_settings:
                     settings.source_volume.value = value
-                return self.skipper.activate_registry()
+                return self._activate_coalesced(command, langs)
             elif command == "set vmix speaker background volume":
                 # details: {"value": numeric_value}  - volume in decibels
                 if "value" not in details:
@@ -1205,7 +1538,7 @@ class Skipper(LockableObject):
                     return ExecutionStatus(False, f"Couldn't parse source volume: {details}")
                 for settings in minion_settings:
                     settings.vmix_speaker_background_volume.value = value
-                return self.skipper.activate_registry()
+                return self._activate_coalesced(command, langs)
             elif command == "set sidechain settings":
                 # details: {"ratio": ..., "release_time": ..., "threshold": ..., "output_gain": ...}
                 # all parameters are numeric
@@ -1231,7 +1564,7 @@ class Skipper(LockableObject):
                             settings.sidechain_settings.enabled = bool(details["enabled"])
                 except Exception as ex:
                     return ExecutionStatus(False, f"Couldn't parse sidechain settings: {details}")
-                return self.skipper.activate_registry()
+                return self._activate_coalesced(command, langs)
             elif command == "set teamspeak limiter settings":
                 # details: {"threshold": ..., "release_time": ...}
                 # all parameters are numeric
@@ -1251,7 +1584,7 @@ class Skipper(LockableObject):
                             settings.ts_limiter_settings.enabled = bool(details["enabled"])
                 except Exception as ex:
                     return ExecutionStatus(False, f"Couldn't parse limiter settings: {details}")
-                return self.skipper.activate_registry()
+                return self._activate_coalesced(command, langs)
             elif command == "set teamspeak gain settings":
                 # details: {"gain": ...}
                 # all parameters are numeric
@@ -1265,7 +1598,7 @@ class Skipper(LockableObject):
                             settings.ts_gain_settings.enabled = bool(details["enabled"])
                 except Exception as ex:
                     return ExecutionStatus(False, f"Couldn't parse gain settings: {details}")
-                return self.skipper.activate_registry()
+                return self._activate_coalesced(command, langs)
             elif command == "set transition settings":
                 # details: {"transition_point": ...}
                 # all parameters are numeric
@@ -1277,10 +1610,24 @@ class Skipper(LockableObject):
                     return ExecutionStatus(False, f"Couldn't parse transition settings: {details}")
                 for settings in minion_settings:
                     settings.transition_settings.transition_point = transition_point
-                return self.skipper.activate_registry()
+                return self._activate_coalesced(command, langs)
             else:
                 return ExecutionStatus(False, f"Invalid command '{command}'")
 
+        def _activate_coalesced(self, command, langs) -> ExecutionStatus:
+            """
+            Activates the registry right away, and once more for the burst of the same command for the same langs
+            sent meanwhile (e.g. a slider being dragged). The registry has already been changed by every caller,
+            so the activation of the burst applies the latest values, and its status is returned to every caller
+            """
+            key = (command, langs if langs == "*" else tuple(sorted(langs)))
+            return self.coalescer.run(key, self.skipper.activate_registry)
+
+        def minion_command(self, command, details=None, langs=None) -> ExecutionStatus:
+            """Sends a command to minions on behalf of the Skipper itself, see _minion_command()"""
+            with self.skipper.infrastructure_lock:
+                return self._minion_command(command=command, details=details, langs=langs)
+
         def _minion_command(self, command, details=None, langs=None, session: SessionContext = None) -> ExecutionStatus:
             """
             If lang is None -> broadcasts the command across all minions. Note that for specific commands
@@ -1312,24 +1659,52 @@ class Skipper(LockableObject):
                         },
                     )
                 else:  # if langs are specified and are present in self.minions
+                    def lang_status(ws_response: WebsocketResponse) -> dict:
+                        # parse a status and convert it into a dictionary. The response is read once,
+                        # so that the status is consistent even if the response is being received right now
+                        result, latency_ms = ws_response.result(), ws_response.latency_ms()
+                        in_time = latency_ms is not None and latency_ms <= ws_response.timeout * 1000
+                        return {
+                            **(
+                                ExecutionStatus.from_json(result)
+                                # minion has not returned - means the minion didn't return anything
+                                # or a timeout error has been thrown
+                                if result and in_time
+                                else ExecutionStatus(False, "Minion has not returned")
+                            ).dict(),
+                            "latency_ms": latency_ms if in_time else None,
+                        }
+
+                    def progress_foo_maker(lang):
+                        def foo(ws_response: WebsocketResponse):
+                            status = lang_status(ws_response)
+                            if status["latency_ms"] is None:  # too late, reported as failed after waiting
+                                return
+                            self.skipper.event_sender.send_command_progress(
+                                session.sid, session.progress_id, command, lang, status
+                            )
+
+                        return foo
+
+                    stream_progress = session is not None and session.progress_id is not None and session.sid
                     # emit commands
-                    ws_responses = [
-                        [lang, self.skipper.minions[lang].command(command=command, details=details)]
-                        for lang in langs
-                    ]  # emit commands
-                    WebsocketResponse.wait_for([ws_response for _, ws_response in ws_responses])  # wait for responses
+                    ws_responses = []
+                    for lang in langs:
+                        ws_response = self.skipper.minions[lang].command(command=command, details=details)
+                        if stream_progress:
+                            ws_response.add_done_callback(progress_foo_maker(lang))
+                        ws_responses.append([lang, ws_response])
+                    WebsocketResponse.wait_all([ws_response for _, ws_response in ws_responses])  # wait for responses
 
                     statuses: Dict[str, Dict] = {
-                        # parse a status and convert it into a dictionary
-                        lang: (
-                            ExecutionStatus.from_json(ws_response.result())
-                            # minion has not returned - means the minion didn't return anything
-                            # or a timeout error has been thrown
-                            if ws_response.result()
-                            else ExecutionStatus(False, "Minion has not returned")
-                        ).dict()
-                        for lang, ws_response in ws_responses
+                        lang: lang_status(ws_response) for lang, ws_response in ws_responses
                     }
+                    if stream_progress:  # report minions which have not returned in time as well
+                        for lang, _ in ws_responses:
+                            if statuses[lang]["latency_ms"] is None:
+                                self.skipper.event_sender.send_command_progress(
+                                    session.sid, session.progress_id, command, lang, statuses[lang]
+                                )
                     # one vs all
                     return ExecutionStatus(
                         all([status["result"] for status in statuses.values()]), serializable_object=statuses
@@ -1351,13 +1726,13 @@ class Skipper(LockableObject):
             :param langs: if specified, takes only specified langs from google sheets
             :return: ExecutionStatus
             """
-            with self.skipper.registry_lock:
-                if sheet_url and sheet_name:
-                    status: ExecutionStatus = self.skipper.obs_config.setup(sheet_url, sheet_name)
-                    if not status:
-                        return status
+            # obs_config manages the registry lock itself, so that it is not held while fetching the sheet
+            if sheet_url and sheet_name:
+                status: ExecutionStatus = self.skipper.obs_config.setup(sheet_url, sheet_name)
+                if not status:
+                    return status
 
-                return self.skipper.obs_config.pull(langs=langs)
+            return self.skipper.obs_config.pull(langs=langs)
 
         def pull_users_config(self, sheet_url=None, sheet_name=None) -> ExecutionStatus:
             if sheet_url and sheet_name:
@@ -1431,28 +1806,25 @@ class Skipper(LockableObject):
         def __init__(self, skipper):
             super(Skipper.BGWorker, self).__init__()
             self.skipper: Skipper = skipper
-            self._last_registry_state = self.skipper.registry.masked_json()
-            self._last_registry_dict = self.skipper.registry.dict()
+            self._last_registry_dict = self.skipper.registry.snapshot()
+            self.registry_version = 0  # increases monotonically with every broadcast patch
+            # [... (version, patch), ...], where patch transforms registry of (version - 1) into version
+            self._registry_patches = deque(maxlen=REGISTRY_PATCH_HISTORY)
+            self._broadcast_lock = RLock()
 
         def track_registry_change(self):
             """
-            This function has to be started as a background worker. It tracks registry changes and broadcasts
-            registry change to all changes.
+            This function has to be started as a background worker. It waits on the registry change journal
+            (see Registry.mark_changed()) and broadcasts registry patches to all clients. Every field assignment
+            is journaled, so a burst of them is collected for REGISTRY_BROADCAST_DEBOUNCE_MS and diffed once.
             """
             while True:
                 try:
-                    with self.skipper.registry_lock:
-                        new_registry_state = self.skipper.registry.masked_json()
-                        # Compare prev state json and current state json
-                        if self._last_registry_state != new_registry_state:
-                            # Get changed values
-                            new_registry_dict = self.skipper.registry.masked_dict()
-                            changes = self._get_registry_changes(new_registry_dict)
-                            # Save current state
-                            self._last_registry_state = new_registry_state
-                            self._last_registry_dict = new_registry_dict
-                            # Send registry changed event
-                            self.skipper.event_sender.send_registry_change(changes)
+                    # the registry may be replaced (see Skipper.load_from_disk()), so wait with a timeout
+                    # and pick up the current instance on every iteration
+                    if self.skipper.registry.wait_for_changes(timeout=1.0):
+                        self.skipper.sio.sleep(seconds=REGISTRY_BROADCAST_DEBOUNCE_MS / 1000)
+                        self.broadcast_registry_changes()
                 except Exception as ex:
                     print(f"E Skipper::BGWorker::track_registry_change(): "
                           f"Couldn't broadcast registry change. Details: {ex}")  # TODO: handle and log
@@ -1460,7 +1832,6 @@ class Skipper(LockableObject):
                         message="Couldn't broadcast registry change",
                         error=ex
                     )
-                self.skipper.sio.sleep(0.2)
 
         def track_gsheet_users_change(self):
             """
@@ -1468,9 +1839,9 @@ class Skipper(LockableObject):
             """
             while True:
                 try:
-                    with self.skipper.registry_lock:
-                        if self.skipper.security.users_sheet.setup_status:
-                            self.skipper.security.sync_from_sheets()
+                    # SecurityWorker takes its own lock only to swap users, network I/O is done outside of locks
+                    if self.skipper.security.users_sheet.setup_status:
+                        self.skipper.security.sync_from_sheets()
                 except Exception as ex:
                     print(f"E Skipper::BGWorker::track_gsheet_users_change(): "
                           f"Couldn't track user password changes. Details: {ex}")  # TODO: handle and log
@@ -1483,20 +1854,67 @@ class Skipper(LockableObject):
         def start_sending_time(self):
             while True:
                 try:
-                    self.skipper.sio.emit("on_datetime_update",
-                                          data=datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S"),
-                                          broadcast=True)
+                    self.skipper.event_sender.send_datetime_update()
                 except Exception as ex:
                     print(f"BGWorker::start_sending_time(): Couldn't send time. Details: {ex}")
                 self.skipper.sio.sleep(1)
 
-        def _get_registry_changes(self, current: dict) -> dict:
-            prev = self._last_registry_dict
-            diff = {}
-            for root_key, current_val in current.items():
-                if orjson_dumps(current_val) != orjson_dumps(prev[root_key]):
-                    diff[root_key] = current_val
-            return diff
+        def broadcast_registry_changes(self):
+            """
+            Drains the registry change journal, computes a leaf-level patch of the changed root keys against
+            the last broadcast state, bumps the registry version and sends the patch to clients.
+            Can be called directly to flush pending changes without waiting for the background worker.
+            """
+            # the registry lock is not needed: a change made while serializing is journaled and broadcast next time
+            with self._broadcast_lock:
+                changed_keys = self.skipper.registry.drain_changes(timeout=0)
+                if not changed_keys:
+                    return
+                # serialize only the keys which have been changed
+                new_registry_dict = self.skipper.registry.snapshot(include=changed_keys)
+                patch = []
+                for root_key, current_val in new_registry_dict.items():
+                    patch.extend(make_json_patch(self._last_registry_dict.get(root_key), current_val,
+                                                 path=f"/{root_key}"))
+                self._last_registry_dict.update(new_registry_dict)
+                if not patch:
+                    return
+
+                self.registry_version += 1
+                self._registry_patches.append((self.registry_version, patch))
+                self.skipper.event_sender.send_registry_change(self.registry_version)
+
+        def get_registry_patch(self, base_version: int):
+            """
+            Returns a patch which transforms registry of `base_version` into the current version,
+            or None if `base_version` is out of the history kept
+            """
+            with self._broadcast_lock:
+                if base_version == self.registry_version:
+                    return []
+                if not self._registry_patches or base_version > self.registry_version or \
+                        base_version < self._registry_patches[0][0] - 1:
+                    return None
+                return [op for version, patch in self._registry_patches if version > base_version for op in patch]
+
+        def get_registry_state(self, sids: List[str] = None, masked=True, flush=False) -> tuple:
+            """
+            Returns (version, masked registry dict) as of the last broadcast, atomically with broadcasts.
+            :param sids: if specified, the version is recorded as delivered to these clients
+            :param masked: if False, the unmasked registry is returned
+            :param flush: broadcast pending changes first, so that the version is the latest one
+            """
+            with self._broadcast_lock:
+                if flush:
+                    self.broadcast_registry_changes()
+                if masked:
+                    registry = dict(self._last_registry_dict)
+                else:
+                    with self.skipper.registry_lock:
+                        registry = self.skipper.registry.dict()
+                for sid in sids or []:
+                    self.skipper.event_sender.client_versions[sid] = self.registry_version
+                return self.registry_version, registry
 
     def __init__(self, port=None):
         super(Skipper, self).__init__()
@@ -1512,8 +1930,8 @@ class Skipper(LockableObject):
         self.command: Skipper.Command = Skipper.Command(self)
         self.bg_worker: Skipper.BGWorker = Skipper.BGWorker(self)
 
-        self.registry_lock = RLock()
-        self.infrastructure_lock = RLock()
+        self.registry_lock = TimedLock("registry_lock")
+        self.infrastructure_lock = TimedLock("infrastructure_lock")
 
         self.port = port
         self.sio = socketio.Server(async_mode="threading", cors_allowed_origins="*", )
@@ -1539,49 +1957,81 @@ class Skipper(LockableObject):
     #             super(Skipper, self).__setattr__(key, value)
 
     def activate_registry(self) -> ExecutionStatus:
-        with self.registry_lock:
-            # check if there are all minions deployed
-            status: ExecutionStatus = self.infrastructure.activate_registry()
-            if not status:
-                return status
+        """
+        Sends changed (not active) configs to their minions. At most ACTIVATION_CONCURRENCY minions are
+        activated at once, and the registry lock is neither held while provisioning minions nor while
+        waiting for them. Configs are serialized and sent under the infrastructure lock, so that an older
+        config is never sent after a newer one. Lock order: infrastructure lock, then registry lock
+        """
+        # check if there are all minions deployed
+        status: ExecutionStatus = self.infrastructure.activate_registry()
+        if not status:
+            return status
 
-            try:
-                # with self.registry_lock:
-                # select only those configs which have been changed (not active)
-                configs_to_activate = [
-                    [lang, minion_config]
-                    for lang, minion_config in self.registry.minion_configs.items()
-                    if not minion_config.active()
-                ]
-                with self.infrastructure_lock:
-                    # collect websocket responses
-                    responses = [
-                        [lang, self.minions[lang].apply_config(minion_config=minion_config)]
-                        for lang, minion_config in configs_to_activate
-                        if lang in self.minions
-                    ]
-                    # wait until websocket callback or timeout
-                    WebsocketResponse.wait_for(responses=[r for _, r in responses])
-
-                    statuses: Dict[str, ExecutionStatus] = {}  # lang: ExecutionStatus
-
-                    for lang, response in responses:
-                        if response.result():
-                            statuses[lang] = ExecutionStatus.from_json(response.result())  # convert result into status
-                            if statuses[lang]:  # and check it
-                                # with self.registry_lock:
-                                self.registry.minion_configs[lang].activate()
-                        else:
-                            statuses[lang] = ExecutionStatus(False, "Minion didn't return")
+        try:
+            statuses: Dict[str, ExecutionStatus] = {}  # lang: ExecutionStatus
+            latencies: Dict[str, float] = {}  # lang: ms or None
+            with self.infrastructure_lock:
+                with self.registry_lock:
+                    # select only those configs which have been changed (not active), serialized as they are sent,
+                    # so that changes made while the minions are applying them are not lost.
+                    # Configs which have been activated before are sent as patches of the modified subjects only
+                    configs_to_activate = {
+                        lang: minion_config.json()
+                        for lang, minion_config in self.registry.minion_configs.items()
+                        if not minion_config.active() and lang in self.minions
+                    }
+                    patches = {lang: self.registry.minion_configs[lang].patch() for lang in configs_to_activate}
 
-                    return ExecutionStatus(
-                        all([status.status for status in statuses.values()]),  # one vs all
-                        serializable_object={  # form status as a dictionary of statuses
-                            lang: status.dict() for lang, status in statuses.items()
-                        },
-                    )
-            except Exception as ex:
-                return ExecutionStatus(False, f"Something happened while activating skipper's registry. Details: {ex}")
+                if not configs_to_activate:
+                    return ExecutionStatus(True, serializable_object={})
+
+                workers = min(ACTIVATION_CONCURRENCY, len(configs_to_activate))
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="activation") as pool:
+                    futures = {
+                        pool.submit(self._activate_minion, self.minions[lang], config_json, patches[lang]): lang
+                        for lang, config_json in configs_to_activate.items()
+                    }
+                    for future in as_completed(futures):  # apply results as they arrive
+                        lang = futures[future]
+                        statuses[lang], latencies[lang] = future.result()
+                        if statuses[lang]:
+                            with self.registry_lock:
+                                minion_config = self.registry.minion_configs.get(lang)
+                                # the config could have been changed meanwhile, then it is still to be activated
+                                if minion_config is not None and minion_config.json() == configs_to_activate[lang]:
+                                    minion_config.activate()
+
+            return ExecutionStatus(
+                all([status.status for status in statuses.values()]),  # one vs all
+                serializable_object={  # form status as a dictionary of statuses
+                    lang: {**status.dict(), "latency_ms": latencies[lang]} for lang, status in statuses.items()
+                },
+            )
+        except Exception as ex:
+            return ExecutionStatus(False, f"Something happened while activating skipper's registry. Details: {ex}")
+
+    @staticmethod
+    def _activate_minion(minion: "Skipper.Minion", config_json: str, patch: dict = None):
+        """
+        Sends the config (or its patch, if specified) to the minion and waits for the response.
+        The whole config is sent if the minion can't apply the patch (e.g. it has been restarted).
+        Returns (ExecutionStatus, latency in ms)
+        """
+        try:
+            if patch is not None:
+                response = minion.patch_config(patch)
+            else:
+                response = minion.command(command="set config", details={"info": config_json})
+        except Exception as ex:
+            return ExecutionStatus(False, f"Couldn't send the config. Details: {ex}"), None
+        WebsocketResponse.wait_all([response])  # wait until websocket callback or timeout
+        if not response.result():
+            return ExecutionStatus(False, "Minion didn't return"), None
+        status = ExecutionStatus.from_json(response.result())
+        if patch is not None and not status and PATCH_NEEDS_FULL_CONFIG in status.message:
+            return Skipper._activate_minion(minion, config_json)
+        return status, response.latency_ms()
 
     def save_to_disk(self):
         registry_json = self.registry.json()
@@ -1603,6 +2053,8 @@ class Skipper(LockableObject):
                 content = fp.read()
                 if content:
                     self.registry = Registry.parse_raw(content)
+        # let the broadcaster compare every key of the freshly loaded registry
+        self.registry.mark_changed(*Registry.__fields__.keys())
         # Load infrastructure
         self.infrastructure = Skipper.Infrastructure(self)
         if os.path.isfile("./dump_infra.json"):
@@ -1628,6 +2080,7 @@ class Skipper(LockableObject):
         self.sio.on("connect", handler=self._on_connect)
         self.sio.on("disconnect", handler=self._on_disconnect)
         self.sio.on("command", handler=self._on_command)
+        self.sio.on("registry_resync", handler=self._on_registry_resync)
         self.http_api.setup_event_handlers()
 
     def _setup_background_tasks(self):
@@ -1664,6 +2117,7 @@ class Skipper(LockableObject):
     def _on_disconnect(self, sid):
         if sid in self._sessions:
             self.security.logout(sid)
+            self.event_sender.forget_client(sid)
             self._sessions.pop(sid)
 
     def _on_command(self, sid, data):
@@ -1674,6 +2128,10 @@ class Skipper(LockableObject):
         except Exception as ex:
             return ExecutionStatus(False, f"Details: {ex}").json()
 
+    def _on_registry_resync(self, sid, data=None):
+        if sid in self.security.authorized_users:
+            self.event_sender.send_registry_resync([sid])
+
     def run(self):
         self._setup_event_handlers()
         self._setup_background_tasks()
@@ -0,0 +1,52 @@
+import unittest
+
+from models import MinionSettings, Registry, VmixPlayer
+
+
+class RegistryChangesTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.update_minion("Eng", MinionSettings.default())
+        self.registry.snapshot()  # fill the cache
+        self.registry.drain_changes(timeout=0)
+
+    def test_nested_field_change(self):
+        self.registry.minion_configs["Eng"].ts_volume.value = -5.0
+
+        self.assertEqual(self.registry.drain_changes(timeout=0), {"minion_configs"})
+        self.assertEqual(self.registry.snapshot()["minion_configs"]["Eng"]["ts_volume"]["value"], -5.0)
+
+    def test_subject_replacement(self):
+        self.registry.minion_configs["Eng"].ts_volume = MinionSettings.TSVolume(value=-7.0)
+
+        self.assertEqual(self.registry.drain_changes(timeout=0), {"minion_configs"})
+        self.assertEqual(self.registry.snapshot()["minion_configs"]["Eng"]["ts_volume"]["value"], -7.0)
+        # the new subject reports its own changes too
+        self.registry.minion_configs["Eng"].ts_volume.value = -8.0
+        self.assertEqual(self.registry.drain_changes(timeout=0), {"minion_configs"})
+        self.assertEqual(self.registry.snapshot()["minion_configs"]["Eng"]["ts_volume"]["value"], -8.0)
+
+    def test_unchanged_value_is_not_journaled(self):
+        self.registry.minion_configs["Eng"].ts_volume.value = self.registry.minion_configs["Eng"].ts_volume.value
+
+        self.assertEqual(self.registry.drain_changes(timeout=0), set())
+
+    def test_new_minion(self):
+        settings = MinionSettings.default()
+        settings.source_volume.value = -3.0
+        self.registry.update_minion("Rus", settings)
+
+        self.assertEqual(self.registry.drain_changes(timeout=0), {"minion_configs"})
+        self.assertEqual(self.registry.snapshot()["minion_configs"]["Rus"]["source_volume"]["value"], -3.0)
+
+    def test_nested_container_change_needs_mark_changed(self):
+        self.registry.vmix_players["1.2.3.4"] = VmixPlayer(name="MOSCOW")
+        self.assertNotIn("hidden ip 1", self.registry.snapshot()["vmix_players"])  # in-place, not journaled
+
+        self.registry.mark_changed("vmix_players")
+        self.assertEqual(self.registry.drain_changes(timeout=0), {"vmix_players"})
+        self.assertEqual(self.registry.snapshot()["vmix_players"]["hidden ip 1"]["name"], "MOSCOW")
+
+
+if __name__ == "__main__":
+    unittest.main()
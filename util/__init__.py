@@ -6,6 +6,9 @@ from util.util import (
     ServiceAddrStorage,
     DefaultDict,
     CallbackThread,
+    CallbackScheduler,
+    TimedLock,
+    Coalescer,
 )
 from util.util import (
     hash_passwd,
@@ -17,4 +20,7 @@ from util.util import (
     validate_media_play_params,
     generate_file_md5,
     log,
+    make_json_patch,
+    json_pointer_escape,
+    json_pointer_unescape,
 )
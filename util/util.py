@@ -1,6 +1,8 @@
 import asyncio
 import hashlib
+import heapq
 import json
+import queue
 import re
 import sys
 import threading
@@ -129,6 +131,45 @@ def log(text):
     sys.stdout.flush()
 
 
+def json_pointer_escape(key) -> str:
+    """
+    Escapes a single path token as described in RFC 6901
+    """
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def json_pointer_unescape(token: str) -> str:
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def make_json_patch(prev, current, path="") -> list:
+    """
+    Builds an RFC 6902 style patch (list of "add", "remove" and "replace" operations) which transforms
+    `prev` into `current`. Dictionaries are compared key by key down to the leaves, any other values
+    (including lists) are treated as leaves and replaced as a whole.
+    :param prev: previous state (dict or any json-serializable value)
+    :param current: current state
+    :param path: json pointer of `prev`/`current` inside the document, "" - document root
+    :return: list of {"op": ..., "path": ..., "value": ...}
+    """
+    if not isinstance(prev, dict) or not isinstance(current, dict):
+        if prev == current:
+            return []
+        return [{"op": "replace", "path": path, "value": current}]
+
+    patch = []
+    for key in prev:
+        if key not in current:
+            patch.append({"op": "remove", "path": f"{path}/{json_pointer_escape(key)}"})
+    for key, value in current.items():
+        key_path = f"{path}/{json_pointer_escape(key)}"
+        if key not in prev:
+            patch.append({"op": "add", "path": key_path, "value": value})
+        else:
+            patch.extend(make_json_patch(prev[key], value, key_path))
+    return patch
+
+
 class Response:
     def __init__(self, text, status_code):
         self.text = text
@@ -344,60 +385,144 @@ class GDriveFiles:
         return self.filenames.items()
 
 
+class CallbackScheduler(threading.Thread):
+    """
+    Process-wide timer shared by all CallbackThread objects. Keeps pending callbacks in a min-heap
+    ordered by deadline and sleeps on a condition variable exactly until the nearest deadline
+    (or until a new callback is inserted). Due callbacks are handed over to the owning CallbackThread,
+    so that a slow callback of one owner doesn't delay others.
+    Cancellation is lazy: a callback is stale if its owner's generation counter has changed since insertion,
+    stale entries are dropped when popped or when they take more than a half of the heap.
+    """
+
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="CallbackScheduler", daemon=True)
+        self.cond = threading.Condition()
+        self.heap = []  # [... (deadline, seq, cb), ...], deadline in time.monotonic() seconds
+        self._seq = 0
+        self._stale = 0
+
+    @classmethod
+    def instance(cls) -> "CallbackScheduler":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = CallbackScheduler()
+                cls._instance.start()
+            return cls._instance
+
+    def push(self, deadline, cb):
+        """Should be called with `self.cond` acquired"""
+        self._seq += 1
+        heapq.heappush(self.heap, (deadline, self._seq, cb))
+        if self.heap[0][2] is cb:  # new nearest deadline - wake up the timer
+            self.cond.notify()
+
+    def drop_stale(self, count):
+        """Should be called with `self.cond` acquired"""
+        self._stale += count
+        if self._stale > 64 and self._stale * 2 > len(self.heap):
+            self.heap = [item for item in self.heap if item[2]["__owner__"].is_alive_cb(item[2])]
+            heapq.heapify(self.heap)
+            self._stale = 0
+
+    def run(self):
+        with self.cond:
+            while True:
+                timeout = None
+                if self.heap:
+                    deadline, _, cb = self.heap[0]
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        heapq.heappop(self.heap)
+                        owner: CallbackThread = cb["__owner__"]
+                        if not owner.is_alive_cb(cb):
+                            self._stale = max(self._stale - 1, 0)
+                            continue
+                        owner.dispatch(cb)
+                        continue
+                self.cond.wait(timeout)
+
+
 class CallbackThread(threading.Thread):
     def __init__(self):
-        self.lock = threading.RLock()
-        self.callbacks = []  # list of {"foo": foo, "args": args, "delay": delay}, note: delay in seconds
+        self.scheduler = CallbackScheduler.instance()
+        self.lock = self.scheduler.cond
+        self.queue = queue.SimpleQueue()  # due callbacks, invoked one by one in this thread
         self.running = True
+        self._generations = {}  # cb_type: generation, increments when callbacks of the type are deleted
+        self._clean_generation = 0  # increments when all the callbacks are deleted
+        self._pending = {}  # cb_type: number of callbacks in scheduler's heap
         threading.Thread.__init__(self)
 
     def append_callback(self, foo, delay, args=None, cb_type="none"):
         """
         :param foo:
-        :param delay: delay in seconds, or callable
+        :param delay: delay in seconds, or callable returning it. The callable is evaluated once, right here,
+                      outside of the scheduler's lock
+        :return:
+        """
+        if callable(delay):
+            delay = delay()
+        now = time.monotonic()
+        self._append(foo, now + delay, delay, args, cb_type, now)
+
+    def append_callback_at(self, foo, deadline, args=None, cb_type="none"):
+        """
+        :param foo:
+        :param deadline: absolute time in `time.monotonic()` seconds
         :return:
         """
+        now = time.monotonic()
+        self._append(foo, deadline, deadline - now, args, cb_type, now)
+
+    def _append(self, foo, deadline, delay, args, cb_type, now):
         with self.lock:
-            self.callbacks.append(
-                {
-                    "foo": foo,
-                    "delay": delay,
-                    "args": args,
-                    "__time__": time.time(),
-                    "__done__": False,
-                    "cb_type": cb_type,
-                }
-            )
+            cb = {
+                "foo": foo,
+                "delay": delay,
+                "args": args,
+                "__time__": now,
+                "cb_type": cb_type,
+                "__owner__": self,
+                "__generation__": self._generations.get(cb_type, 0),
+                "__clean_generation__": self._clean_generation,
+            }
+            self._pending[cb_type] = self._pending.get(cb_type, 0) + 1
+            self.scheduler.push(deadline, cb)
 
     def clean_callbacks(self):
         with self.lock:
-            self.callbacks = []
+            self._clean_generation += 1
+            self.scheduler.drop_stale(sum(self._pending.values()))
+            self._pending = {}
 
     def delete_cb_type(self, cb_type):
         with self.lock:
-            self.callbacks = [cb for cb in self.callbacks if cb["cb_type"] != cb_type]
+            self._generations[cb_type] = self._generations.get(cb_type, 0) + 1
+            self.scheduler.drop_stale(self._pending.pop(cb_type, 0))
+
+    def is_alive_cb(self, cb) -> bool:
+        """Should be called with `self.lock` acquired"""
+        return (cb["__clean_generation__"] == self._clean_generation
+                and cb["__generation__"] == self._generations.get(cb["cb_type"], 0))
+
+    def dispatch(self, cb):
+        """Called by the scheduler with `self.lock` acquired when the callback is due"""
+        self._pending[cb["cb_type"]] -= 1
+        if not self._pending[cb["cb_type"]]:
+            self._pending.pop(cb["cb_type"])
+        self.queue.put(cb)
 
     def run(self):
         while self.running:
-            self._check_callbacks()
-            time.sleep(0.01)
-
-    def _check_callbacks(self):
-        with self.lock:
-            for cb in self.callbacks.copy():
-                self._check_callback(cb)
-            self.callbacks = [cb for cb in self.callbacks if not cb["__done__"]]
-
-    def _check_callback(self, cb):
-        if cb["__done__"]:
-            return
-        if callable(cb["delay"]):
-            delay = cb["delay"]()
-        else:
-            delay = cb["delay"]
-        if (time.time() - cb["__time__"]) >= delay:
+            cb = self.queue.get()
+            with self.lock:  # the callback might be deleted after it was dispatched
+                if not self.is_alive_cb(cb):
+                    continue
             self._invoke(cb)
-            cb["__done__"] = True
 
     def _invoke(self, cb):
         try:
@@ -410,6 +535,155 @@ class CallbackThread(threading.Thread):
             print(f"E PYSERVER::CallbackThread::_invoke(): {ex}")
 
 
+class TimedLock:
+    """
+    Reentrant lock which collects wait and hold time statistics.
+    Only the outermost acquire/release pair of a thread is measured
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._stats_lock = Lock()
+        self._acquisitions = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._total_hold = 0.0
+        self._max_hold = 0.0
+        self._max_hold_thread = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        t = time.monotonic()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            self._local.acquired_at = time.monotonic()
+            wait = self._local.acquired_at - t
+            with self._stats_lock:
+                self._acquisitions += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+        self._local.depth = depth + 1
+        return True
+
+    def release(self):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            hold = time.monotonic() - self._local.acquired_at
+            with self._stats_lock:
+                self._total_hold += hold
+                if hold > self._max_hold:
+                    self._max_hold = hold
+                    self._max_hold_thread = threading.current_thread().name
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def stats(self) -> dict:
+        """Returns lock statistics, times are in milliseconds"""
+        with self._stats_lock:
+            n = max(self._acquisitions, 1)
+            return {
+                "acquisitions": self._acquisitions,
+                "avg_wait_ms": round(self._total_wait / n * 1000, 3),
+                "max_wait_ms": round(self._max_wait * 1000, 3),
+                "avg_hold_ms": round(self._total_hold / n * 1000, 3),
+                "max_hold_ms": round(self._max_hold * 1000, 3),
+                "max_hold_thread": self._max_hold_thread,
+            }
+
+
+class Coalescer:
+    """
+    Merges calls with the same key into as few calls as possible. A call made while no call with the same key
+    is running is called right away (leading edge). Calls made while it is running form a batch, which is
+    called once, after the running call has finished and at least `window` seconds after it has started
+    (trailing edge). The result (or the exception) of the batch call is returned to every caller of the batch
+    """
+
+    class _Batch:
+        def __init__(self):
+            self.go = threading.Event()  # set when the call running has finished
+            self.event = threading.Event()  # set when the batch has been called
+            self.result = None
+            self.exception = None
+
+    def __init__(self, window):
+        """
+        :param window: minimum interval between the calls with the same key in seconds, 0 - disables coalescing
+        """
+        self.window = window
+        self._running = {}  # key: time.monotonic() the call running has been started at
+        self._batches = {}  # key: _Batch, which is waiting for the call running to finish
+        self._lock = Lock()
+        self._calls = 0
+        self._runs = 0
+
+    def run(self, key, foo):
+        if self.window <= 0:
+            return foo()
+
+        with self._lock:
+            self._calls += 1
+            batch = self._batches.get(key)
+            is_leader = batch is None  # the first caller of a batch calls it
+            if key not in self._running:
+                self._running[key] = time.monotonic()
+                self._runs += 1
+            elif is_leader:
+                batch = self._batches[key] = Coalescer._Batch()
+
+        if batch is None:  # leading edge
+            try:
+                return foo()
+            finally:
+                self._finish(key)
+
+        if not is_leader:  # wait for the result of the batch
+            batch.event.wait()
+            if batch.exception is not None:
+                raise batch.exception
+            return batch.result
+
+        batch.go.wait()
+        with self._lock:
+            started_at = self._running[key]
+        time.sleep(max(started_at + self.window - time.monotonic(), 0))
+        with self._lock:  # callers coming from now on start a new batch
+            self._batches.pop(key)
+            self._running[key] = time.monotonic()
+            self._runs += 1
+        try:
+            batch.result = foo()
+            return batch.result
+        except BaseException as ex:
+            batch.exception = ex
+            raise
+        finally:
+            batch.event.set()
+            self._finish(key)
+
+    def _finish(self, key):
+        """Hands the key over to the batch waiting, if any"""
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is not None:
+                batch.go.set()  # the key stays running until the batch has been called
+            else:
+                self._running.pop(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self._calls, "runs": self._runs, "coalesced": self._calls - self._runs}
+
+
 class ServerState:
     SLEEPING = "sleeping"
     NOT_INITIALIZED = "not initialized"
@@ -462,26 +736,65 @@ class ServerState:
 class WebsocketResponse:
     @classmethod
     def wait_for(cls, responses):
-        if not responses:
-            return responses
-        while not all([r.done() for r in responses]):
-            time.sleep(0.1)
+        return cls.wait_all(responses)
+
+    @classmethod
+    def wait_all(cls, responses, timeout=None):
+        """
+        Blocks until every response has been received or has timed out, returns the moment the last one arrives.
+        :param timeout: overall timeout in seconds, if None - every response waits for its own timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for r in responses:
+            r_deadline = r.t + r.timeout if deadline is None else min(r.t + r.timeout, deadline)
+            r._event.wait(max(r_deadline - time.monotonic(), 0))
         return responses
 
     def __init__(self, timeout=5.0):
-        self.t = time.time()
+        self.t = time.monotonic()
         self.timeout = timeout
         self.response = None
-        self._done = False
+        self.response_time = None  # time.monotonic() the response has been received at
+        self._event = threading.Event()
+        self._lock = Lock()
+        self._done_callbacks = []
 
     def callback(self, *data):
         self.response = data
         if isinstance(self.response, tuple) and len(self.response) == 1:
             self.response = self.response[0]
-        self._done = True
+        self.response_time = time.monotonic()
+        with self._lock:
+            self._event.set()
+            done_callbacks, self._done_callbacks = self._done_callbacks, []
+        for foo in done_callbacks:
+            self._invoke_done_callback(foo)
+
+    def add_done_callback(self, foo):
+        """
+        Calls foo(response) once the response has been received (immediately, if it already has been).
+        Note that foo is not called if the response times out
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._done_callbacks.append(foo)
+                return
+        self._invoke_done_callback(foo)
+
+    def _invoke_done_callback(self, foo):
+        try:
+            foo(self)
+        except Exception as ex:
+            print(f"E PYSERVER::WebsocketResponse::_invoke_done_callback(): {ex}")
 
     def done(self):
-        return self._done or (time.time() - self.t) >= self.timeout
+        return self._event.is_set() or (time.monotonic() - self.t) >= self.timeout
 
     def result(self):
         return self.response
+
+    def latency_ms(self):
+        """Returns round-trip time in milliseconds, or None if the response has not been received"""
+        if self.response_time is None:
+            return None
+        return round((self.response_time - self.t) * 1000, 3)